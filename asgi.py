@@ -0,0 +1,271 @@
+# Асинхронный (ASGI) режим сервера: приём измерений и чтение данных.
+# Дополнительные зависимости: quart, httpx, pymongo >= 4.9 (AsyncMongoClient).
+# Запуск: hypercorn asgi:app
+# Остальные маршруты (настройки, страницы) пока обслуживает main.py
+from quart import Quart, request, Response, abort
+from quart.wrappers.response import DataBody
+from pymongo import AsyncMongoClient
+import asyncio
+import datetime
+import httpx
+import time
+import env
+from classes import *
+from main import registry, FastJSONProvider, compress, set_compressed
+
+# Prepare
+
+
+class AsyncDatabaseLink:
+    """Асинхронная запись измерений в БД"""
+
+    def __init__(self, host: str, username: str, password: str, database: str) -> None:
+        self.client = AsyncMongoClient(
+            host=host, username=username, password=password, authSource=database, authMechanism="SCRAM-SHA-256")
+        self.db = self.client[database]
+
+    async def send_many(self, collection: str, records: list[dict]):
+        await self.db[collection].insert_many(records, ordered=False)
+
+    async def update_rollups(self, collection: str, match: dict, records: list[tuple]):
+        for name, operations in rollup_operations(collection, match, records).items():
+            await self.db[name].bulk_write(operations)
+
+    async def close(self):
+        await self.client.close()
+
+
+class AsyncControlLoop(ControlLoop):
+    """Цикл отчёта и автоуправления в цикле событий asyncio.
+    Команды на ИУ отправляются одновременно асинхронным HTTP-клиентом"""
+
+    def __init__(self, rooms: list[Room], client: httpx.AsyncClient,
+                 tick: float = CONTROL_TICK, debounce: float = CONTROL_DEBOUNCE,
+                 lease: LeaderLease = None) -> None:
+        super().__init__(rooms, tick, debounce, lease=lease)
+        self.client = client
+        self._loop: asyncio.AbstractEventLoop = None
+        self._event = asyncio.Event()
+        self._task: asyncio.Task = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._task = self._loop.create_task(self._run())
+        print(f"Async control loop started for {len(self.rooms)} rooms")
+
+    async def stop(self):
+        self._task.cancel()
+
+    def notify(self, room: Room):
+        """Сообщить о новых данных в помещении (из любого потока)"""
+        with self._dirty_lock:
+            self._dirty[room.name] = room
+        self._loop.call_soon_threadsafe(self._event.set)
+
+    async def _run(self):
+        next_tick = time.monotonic() + self.tick
+        while True:
+            try:
+                await asyncio.wait_for(self._event.wait(),
+                                       max(next_tick - time.monotonic(), 0))
+                await asyncio.sleep(self.debounce)
+            except asyncio.TimeoutError:
+                pass
+            self._event.clear()
+            with self._dirty_lock:
+                rooms = list(self._dirty.values())
+                self._dirty.clear()
+            if time.monotonic() >= next_tick:
+                rooms = self.rooms
+                next_tick = time.monotonic() + self.tick
+            await asyncio.gather(*(self.cycle(room) for room in rooms))
+
+    async def cycle(self, room: Room):
+        """Составить отчёт и применить автоуправление"""
+        try:
+            await asyncio.to_thread(room.sync_state)
+            report = await asyncio.to_thread(room.get_report)
+            if report is None:
+                return
+            self._notify(room, report)
+            if self.lease is not None and \
+                    not await asyncio.to_thread(self.lease.held):
+                return
+            commands = room.plan_autocontrol(report)
+            await asyncio.gather(*(self.switch_power(executor, power)
+                                   for executor, power in commands))
+            if commands:
+                room.touch()
+        except Exception as error:
+            print(f"Control cycle of room {room.name} failed: {error}")
+
+    async def switch_power(self, executor: Executor, power: bool):
+        try:
+            res = await self.client.post(executor.address, json={"switch_power": power},
+                                         headers={"Auth": executor.token}, timeout=1.5)
+            res = res.json()
+        except Exception:
+            res = {"error": "timeout"}
+        await asyncio.to_thread(executor.record_power, power, res)
+
+
+adb = AsyncDatabaseLink(database=env.DB_DATABASE, host=env.DB_HOST,
+                        username=env.DB_USERNAME, password=env.DB_PASSWORD)
+
+app = Quart(__name__, static_folder="static")
+# Те же сериализация и сжатие ответов, что и у Flask-приложения
+app.json = FastJSONProvider(app)
+
+
+@app.after_request
+async def compress_response(response):
+    """Сжать ответ /api/get/* (brotli или gzip по Accept-Encoding)"""
+    if not request.path.startswith("/api/get/") or response.status_code != 200 \
+            or not isinstance(response.response, DataBody) \
+            or "Content-Encoding" in response.headers:
+        return response
+    data, encoding = compress(await response.get_data(), request.accept_encodings)
+    if encoding is not None:
+        set_compressed(response, data, encoding)
+    return response
+
+
+@app.before_serving
+async def startup():
+    # Потоковый цикл из main.py заменяется асинхронным
+    registry.control_loop.stop()
+    app.http_client = httpx.AsyncClient()
+    registry.control_loop = AsyncControlLoop(registry.control_loop.rooms,
+                                             app.http_client,
+                                             lease=registry.control_loop.lease)
+    registry.control_loop.add_listener(registry.publish_report)
+    registry.control_loop.start()
+
+
+@app.after_serving
+async def shutdown():
+    await registry.control_loop.stop()
+    await app.http_client.aclose()
+    await adb.close()
+
+
+async def processing_request(token, data) -> int:
+    """Принять измерение датчика, не занимая поток на время записи в БД"""
+    if token == ("" or None):
+        return 403
+    route = registry.route(token)
+    if route is None:
+        return 401
+    if data == ("" or None):
+        return 400
+    room, sensor = route
+    _, records = sensor.make_records([data], [None])
+    if len(records) == 0:
+        return 201
+    await adb.send_many(sensor.collection, records)
+    await adb.update_rollups(sensor.collection, sensor.scope,
+                             [(x["date"], x[sensor.field]) for x in records])
+    sensor.remember(records)
+    registry.control_loop.notify(room)
+    return 201
+
+
+async def get_room() -> Room:
+    """Помещение из параметра ?room= (по умолчанию первое)"""
+    room = registry.get(request.args.get("room"))
+    if room is None:
+        abort(404)
+    await asyncio.to_thread(room.sync_state)
+    return room
+
+# API
+
+
+@app.route("/api/device/send", methods=["POST"])
+async def api_device_send():
+    body = await request.get_json()
+    code = await processing_request(body["Auth"], body["value"])
+    return Response(status=code)
+
+
+@app.route("/api/get/settings")
+async def api_send_settings():
+    room = await get_room()
+    return {
+        "co2": {"acceptable": room.co2_requirement_acceptable,
+                "harmful": room.co2_requirement_harmful,
+                "danger": room.co2_requirement_danger},
+        "temperature": {"inf": room.temperature_requirement_inf,
+                        "sup": room.temperature_requirement_sup},
+        "humidity": {"inf": room.humidity_requirement_inf,
+                     "sup": room.humidity_requirement_sup},
+        "period": {"forecast": room.forecast_period.seconds,
+                   "report": room.report_period.seconds}
+    }
+
+
+@app.route("/api/get/device_status")
+async def api_get_devices_statistic():
+    room = await get_room()
+    report = await asyncio.to_thread(room.get_report)
+    executors = room.get_executors()
+    return {"executor_on": report["devices_status"],
+            "executor_setting": {kind: x.settings for kind, x in executors.items()},
+            "executor_address": {kind: x.address for kind, x in executors.items()},
+            "executor_autocontrol": {kind: getattr(room, f"autocontrol_{kind}")
+                                     for kind in executors}}
+
+
+@app.route("/api/get/report", methods=["GET"])
+async def api_get_report():
+    room = await get_room()
+    period = None
+    if request.args.get("period"):
+        period = datetime.timedelta(seconds=int(request.args.get("period")))
+    return await asyncio.to_thread(room.get_report, period)
+
+
+@app.route("/api/get/data", methods=["GET"])
+async def api_get_data():
+    room = await get_room()
+    fields = None
+    points = None
+    if request.args.get("fields"):
+        fields = request.args.get("fields").split(",")
+    if request.args.get("points"):
+        points = max(int(request.args.get("points")), 3)
+    method = request.args.get("method", "lttb")
+    if request.args.get("period"):
+        period = datetime.timedelta(seconds=int(request.args.get("period")))
+    else:
+        period = datetime.timedelta(hours=6)
+    # Только измерения новее ?since= [s эпохи]
+    since = request.args.get("since", type=float)
+    if since is not None:
+        period = min(period, datetime.timedelta(
+            seconds=max(datetime.datetime.now().timestamp() - since, 0)))
+    if request.args.get("format") == "binary":
+        data = await asyncio.to_thread(room.get_history_columns, period,
+                                       fields, points, method, since)
+        return Response(data, mimetype="application/octet-stream")
+    return await asyncio.to_thread(room.get_history, period, fields, points, method, since)
+
+
+@app.route("/api/get/export", methods=["GET"])
+async def api_get_export():
+    room = await get_room()
+    period = datetime.timedelta(seconds=int(request.args.get("period", 6 * 3600)))
+    fields = None
+    if request.args.get("fields"):
+        fields = request.args.get("fields").split(",")
+    fmt = request.args.get("format", "ndjson")
+    batch_size = int(request.args.get("batch", EXPORT_BATCH_SIZE))
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    rows = room.export_history(period, fields, fmt, batch_size)
+
+    async def stream():
+        # Чтение курсора выполняется в потоке, чтобы не блокировать цикл событий
+        while (row := await asyncio.to_thread(next, rows, None)) is not None:
+            yield row
+
+    return Response(stream(), mimetype=mimetype)
@@ -0,0 +1,184 @@
+"""Микробенчмарки аналитики и управления на синтетических данных.
+
+БД подменяется mongomock в этом же процессе, ИУ - заглушками из masquarade.py.
+Чистые вычисления (МНК, прореживание) измеряются на всех размерах,
+запросы к БД - на размерах до --db-max: mongomock хранит записи
+словарями Python и на больших наборах измеряет в основном себя. Время запросов
+сравнимо только между запусками на одной и той же подмене БД.
+
+    python benchmark.py --json results.json
+    python benchmark.py --sizes 1000000,10000000 --compare results.json
+"""
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+import mongomock
+import pymongo
+import env
+
+# Измерения записываются прямо в коллекции, минуя агрегаты и TTL
+env.DB_ROLLUPS = False
+env.DB_WRITE_BEHIND = False
+env.DB_TIMESERIES = False
+env.RETENTION_DAYS = None
+env.LOG_RETENTION_DAYS = None
+env.SHARED_STATE = False
+pymongo.MongoClient = lambda **kwargs: mongomock.MongoClient()
+
+import classes
+from classes import *
+from masquarade import start_stub_executors
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000, 10_000_000]
+# Среднее и размах синтетических показаний по коллекции
+BASES = {"temperature": (22, 2), "humidity": (45, 5), "temperature_outer": (15, 3),
+         "humidity_outer": (50, 5), "co2": (700, 150)}
+
+
+def measure(function, repeat: int) -> dict:
+    """Время выполнения [ms]: лучшее, медиана и среднее по repeat запускам"""
+    function()  # прогрев
+    times = []
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - begin) * 1000)
+    return {"min": min(times), "median": float(np.median(times)),
+            "mean": float(np.mean(times)), "repeat": repeat}
+
+
+def make_series(size: int, window: float, base: tuple, seed: int = 0):
+    """Ряд из size измерений, равномерно покрывающих последние window секунд"""
+    rng = np.random.default_rng(seed)
+    end = time.time() - 1
+    dates = np.linspace(end - window, end, size)
+    mean, spread = base
+    values = mean + spread * np.sin(np.linspace(0, 6 * np.pi, size)) + \
+        rng.normal(0, spread / 10, size)
+    return dates, values
+
+
+def make_room(db: DatabaseLink, executors: str) -> Room:
+    room = Room("bench", db)
+    for pragma in BASES:
+        room.set_sensor(pragma, pragma, f"{pragma}_token")
+    room.set_ac_devices("ac", f"{executors}/ac", "ac_token")
+    room.set_heater_device("heater", f"{executors}/heater", "heater_token")
+    room.set_vent_device("vent", f"{executors}/vent", "vent_token")
+    room.set_humidifier_device("humidifier", f"{executors}/humidifier", "humidifier_token")
+    return room
+
+
+def seed(room: Room, size: int, window: float):
+    """Записать size измерений каждого датчика за окно отчёта"""
+    for index, sensor in enumerate(room.get_sensors().values()):
+        dates, values = make_series(size, window, BASES[sensor.pragma], index)
+        room.db.db[sensor.collection].insert_many(
+            [sensor.make_record(float(value), datetime.datetime.fromtimestamp(date))
+             for date, value in zip(dates, values)])
+        sensor.load_buffer()
+
+
+def bench_pure(size: int, repeat: int) -> dict:
+    dates, values = make_series(size, 3600, BASES["temperature"])
+    return {
+        "quick_lstsq": measure(lambda: quick_lstsq(values, dates), repeat),
+        "downsample_lttb": measure(lambda: downsample_lttb(dates, values, 500), repeat),
+    }
+
+
+def bench_db(size: int, repeat: int, executors: str) -> dict:
+    db = DatabaseLink(database="benchmark", host="localhost",
+                      username=None, password=None)
+    room = make_room(db, executors)
+    period = room.report_period
+    seed(room, size, period.total_seconds())
+    sensor = room.get_sensors()["temperature"]
+    results = {}
+    # Статистика по буферу и оценке тренда в памяти и по запросам к БД
+    for source, authoritative in [("memory", True), ("db", False)]:
+        classes.SENSOR_BUFFER_AUTHORITATIVE = authoritative
+        results[f"sensor.get_average[{source}]"] = measure(
+            lambda: sensor.get_average(period), repeat)
+        results[f"sensor.get_trend[{source}]"] = measure(
+            lambda: sensor.get_trend(period), repeat)
+        results[f"sensor.get_forecast[{source}]"] = measure(
+            lambda: sensor.get_forecast(period, room.forecast_period), repeat)
+        results[f"room.make_report[{source}]"] = measure(
+            lambda: room.make_report(period), repeat)
+    classes.SENSOR_BUFFER_AUTHORITATIVE = SENSOR_BUFFER_AUTHORITATIVE
+    results["room.get_history[raw]"] = measure(
+        lambda: room.get_history(period, MEASUREMENTS), repeat)
+    results["room.get_history[lttb]"] = measure(
+        lambda: room.get_history(period, MEASUREMENTS, 500), repeat)
+    # Пороги ниже синтетических рядов: прогноз температуры tooHigh и опасный CO2,
+    # поэтому автоуправление отправляет команды на заглушки ИУ
+    room.temperature_requirement_inf, room.temperature_requirement_sup = -60, -50
+    room.co2_requirement_acceptable = room.co2_requirement_harmful = \
+        room.co2_requirement_danger = 0
+    for kind in room.get_executors():
+        setattr(room, f"autocontrol_{kind}", True)
+    report = room.make_report(period)
+    if not room.plan_autocontrol(report):
+        raise RuntimeError("autocontrol benchmark sends no commands")
+    results["room.autocontrol"] = measure(lambda: room.autocontrol(report), repeat)
+    db.client.close()
+    return results
+
+
+def get_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list[dict], path: str):
+    """Отношение медиан к сохранённому ранее результату (>1 - медленнее)"""
+    with open(path) as file:
+        old = {(x["name"], x["size"]): x for x in json.load(file)["results"]}
+    print(f"\ncompared with {path}")
+    for x in results:
+        previous = old.get((x["name"], x["size"]))
+        if previous is not None:
+            print(f"{x['name']:<32}{x['size']:>10}{x['median'] / previous['median']:>9.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="размеры наборов данных через запятую")
+    parser.add_argument("--db-max", type=int, default=10_000,
+                        help="наибольший размер для запросов к БД")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="сохранить результат в файл")
+    parser.add_argument("--compare", help="сравнить с сохранённым результатом")
+    args = parser.parse_args()
+
+    executors = start_stub_executors()
+    results = []
+    print(f"{'benchmark':<32}{'size':>10}{'min':>10}{'median':>10}{'mean':>10}  [ms]")
+    for size in map(int, args.sizes.split(",")):
+        measured = bench_pure(size, args.repeat)
+        if size <= args.db_max:
+            measured |= bench_db(size, args.repeat, executors)
+        for name, x in measured.items():
+            results.append({"name": name, "size": size} | x)
+            print(f"{name:<32}{size:>10}{x['min']:>10.3f}{x['median']:>10.3f}{x['mean']:>10.3f}")
+    if args.compare:
+        compare(results, args.compare)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"revision": get_revision(),
+                       "date": datetime.datetime.now().isoformat(),
+                       "python": sys.version.split()[0], "numpy": np.__version__,
+                       "platform": platform.platform(),
+                       "settings": {"layout": DB_LAYOUT, "buffer_size": SENSOR_BUFFER_SIZE,
+                                    "report_period": env.PERIOD_REPORT},
+                       "results": results}, file, indent=2)
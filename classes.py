@@ -1,45 +1,685 @@
 import pymongo
 import datetime
 import numpy as np
-import abc
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import csv
+import functools
+import struct
+import io
+import json
+import math
+import os
+import queue
+import threading
+import time
+import uuid
 import requests
 import env
 from typing import Literal, TypeAlias
 
+try:
+    # Необязательная зависимость: быстрая сериализация JSON
+    import orjson
+except ImportError:
+    orjson = None
+
+
+SENSOR_BUFFER_SIZE = getattr(env, "SENSOR_BUFFER_SIZE", 100_000)
+CONTROL_TICK = getattr(env, "CONTROL_TICK", 30)  # [s]
+CONTROL_DEBOUNCE = getattr(env, "CONTROL_DEBOUNCE", 1)  # [s]
+CONTROL_WORKERS = getattr(env, "CONTROL_WORKERS", 8)
+EXECUTOR_WORKERS = getattr(env, "EXECUTOR_WORKERS", 8)
+MAX_CLOCK_SKEW = getattr(env, "MAX_CLOCK_SKEW", 60)  # [s]
+DB_WRITE_BEHIND = getattr(env, "DB_WRITE_BEHIND", False)
+DB_FLUSH_SIZE = getattr(env, "DB_FLUSH_SIZE", 500)
+DB_FLUSH_INTERVAL = getattr(env, "DB_FLUSH_INTERVAL", 1.0)  # [s]
+DB_QUEUE_SIZE = getattr(env, "DB_QUEUE_SIZE", 10_000)
+DB_TIMESERIES = getattr(env, "DB_TIMESERIES", False)
+DB_LAYOUT = getattr(env, "DB_LAYOUT", "split")  # "split" | "unified"
+DB_ROLLUPS = getattr(env, "DB_ROLLUPS", True)
+# Окно считается по агрегатам уровня, если в нём хотя бы столько корзин
+ROLLUP_MIN_BUCKETS = getattr(env, "ROLLUP_MIN_BUCKETS", 120)
+ROLLUP_TIERS = [("1m", 60), ("1h", 3600)]  # (суффикс коллекции, [s])
+REPORT_CACHE_SIZE = getattr(env, "REPORT_CACHE_SIZE", 32)
+REPORT_CACHE_TTL = getattr(env, "REPORT_CACHE_TTL", 10)  # [s]
+EXPORT_BATCH_SIZE = getattr(env, "EXPORT_BATCH_SIZE", 1000)
+TOKEN_SYNC_INTERVAL = getattr(env, "TOKEN_SYNC_INTERVAL", 1.0)  # [s]
+TOKEN_SYNC_LOOKBACK = getattr(env, "TOKEN_SYNC_LOOKBACK", 16)
+# Настройки помещений и состояние ИУ хранятся в БД, общей для всех процессов
+# Сырые измерения и журнал удаляются из БД по TTL через заданное число суток;
+# измерения перед этим переносятся в сжатые архивы ARCHIVE_DIR (None - без архива)
+RETENTION_DAYS = getattr(env, "RETENTION_DAYS", None)
+LOG_RETENTION_DAYS = getattr(env, "LOG_RETENTION_DAYS", None)
+ARCHIVE_DIR = getattr(env, "ARCHIVE_DIR", "archive")
+ARCHIVE_INTERVAL = getattr(env, "ARCHIVE_INTERVAL", 3600)  # [s]
+STREAM_QUEUE_SIZE = getattr(env, "STREAM_QUEUE_SIZE", 256)
+STREAM_KEEPALIVE = getattr(env, "STREAM_KEEPALIVE", 15)  # [s]
+SHARED_STATE = getattr(env, "SHARED_STATE", False)
+STATE_SYNC_INTERVAL = getattr(env, "STATE_SYNC_INTERVAL", 1.0)  # [s]
+# Команды автоуправления и архив выполняет один процесс, арендующий роль в БД
+LEADER_LEASE_TTL = getattr(env, "LEADER_LEASE_TTL", 60)  # [s]
+# При нескольких процессах буфер видит только свои измерения,
+# поэтому статистика по умолчанию считается по БД
+SENSOR_BUFFER_AUTHORITATIVE = getattr(env, "SENSOR_BUFFER_AUTHORITATIVE",
+                                      not SHARED_STATE)
+
+# Общая коллекция измерений при DB_LAYOUT = "unified"
+MEASUREMENT_COLLECTION = "measurement"
+
+
+class SensorKind:
+    """Тип измерения: допустимый диапазон (не включая границы) и округление"""
+
+    def __init__(self, lower: float, upper: float, digits: int) -> None:
+        self.lower = lower
+        self.upper = upper
+        self.digits = digits
 
-def quick_lstsq(values: list, dates: list[datetime.datetime]):
+    def validate(self, data) -> bool:
+        # Строки, списки, bool и nan/inf измерениями не являются
+        if isinstance(data, bool) or not isinstance(data, (int, float)):
+            return False
+        if not math.isfinite(data):
+            return False
+        return data < self.upper and data > self.lower
+
+    def round(self, value):
+        if value is None:
+            return None
+        return round(float(value), self.digits)
+
+
+SENSOR_KINDS = {
+    "temperature": SensorKind(-60, 100, 1),
+    "humidity": SensorKind(0, 100, 0),
+    "temperature_outer": SensorKind(-60, 100, 1),
+    "humidity_outer": SensorKind(0, 100, 0),
+    "co2": SensorKind(0, 100e3, 0),
+} | {name: SensorKind(*kind) for name, kind in getattr(env, "SENSOR_KINDS", {}).items()}
+# Типы измерений; при раздельной схеме у каждого своя коллекция
+MEASUREMENTS = list(SENSOR_KINDS)
+
+
+def measurement_collections() -> list[str]:
+    """Коллекции измерений при текущей схеме хранения"""
+    if DB_LAYOUT == "unified":
+        return [MEASUREMENT_COLLECTION]
+    return MEASUREMENTS
+
+
+def quick_lstsq(values: list, dates: list[float]):
     try:
         len(values) == len(dates)
     except:
         return IndexError
-    A = np.vstack([[x.timestamp() for x in dates], np.ones(len(dates))]).T
+    dates = np.asarray(dates, dtype=np.float64)
+    # Время центрируется: МНК на секундах эпохи плохо обусловлен
+    center = dates.mean() if len(dates) else 0.0
+    A = np.vstack([dates - center, np.ones(len(dates))]).T
     tg, shift = np.linalg.lstsq(A, values, rcond=None)[0]
+    return (tg, shift - tg * center)
+
+
+def lstsq_from_sums(n, sum_t, sum_v, sum_tt, sum_tv):
+    """МНК по накопленным суммам (время отсчитывается от начала окна)"""
+    det = n * sum_tt - sum_t ** 2
+    if n < 2 or det == 0:
+        return (0.0, sum_v / n if n else 0.0)
+    tg = (n * sum_tv - sum_t * sum_v) / det
+    shift = (sum_v - tg * sum_t) / n
     return (tg, shift)
 
 
+def statistics_from_sums(sums: dict, period_forecast: datetime.timedelta) -> tuple:
+    """Среднее, тренд и прогноз по суммам для среднего и МНК"""
+    if sums["n"] == 0:
+        return (None, 0.0, None)
+    average = sums["sum_v"] / sums["n"]
+    trend = lstsq_from_sums(sums["n"], sums["sum_t"], sums["sum_v"],
+                            sums["sum_tt"], sums["sum_tv"])[0]
+    return (average, trend, trend * period_forecast.seconds + average)
+
+
+def parse_device_date(value) -> datetime.datetime:
+    """Привести время измерения от блока датчика к локальному времени сервера.
+    Принимаются секунды эпохи и строки ISO 8601"""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        raise ValueError("Invalid date")
+    if isinstance(value, (int, float)):
+        return datetime.datetime.fromtimestamp(value)
+    date = datetime.datetime.fromisoformat(value)
+    if date.tzinfo is not None:
+        date = date.astimezone().replace(tzinfo=None)
+    return date
+
+
+def export_default(value):
+    """Сериализация значений, которые не поддерживает json"""
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def json_dumps(value) -> bytes:
+    """Сериализовать в JSON: через orjson, если он установлен.
+    Время - в ISO 8601, скаляры и массивы NumPy - числами"""
+    if orjson is not None:
+        return orjson.dumps(value, default=export_default,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, default=export_default).encode()
+
+
+def pack_columns(columns: dict[str, tuple]) -> bytes:
+    """Упаковать ряды в колоночный бинарный формат (little-endian):
+    b"SRS1", u32 число рядов; для каждого ряда u32 длина имени, имя в UTF-8,
+    u32 число точек, u32 резерв, float64[n] время [ms эпохи], float32[n] значения.
+    Имя и массивы значений дополняются нулями до границы 8 байт"""
+    chunks = [b"SRS1", struct.pack("<I", len(columns))]
+    offset = 8
+
+    def pad():
+        nonlocal offset
+        padding = -offset % 8
+        chunks.append(bytes(padding))
+        offset += padding
+
+    for name, (dates, values) in columns.items():
+        encoded = name.encode("utf-8")
+        chunks.append(struct.pack("<I", len(encoded)) + encoded)
+        offset += 4 + len(encoded)
+        pad()
+        chunks.append(struct.pack("<II", len(dates), 0))
+        offset += 8
+        dates = (np.asarray(dates, dtype="<f8") * 1000).tobytes()
+        values = np.asarray(values, dtype="<f4").tobytes()
+        chunks += [dates, values]
+        offset += len(dates) + len(values)
+        pad()
+    return b"".join(chunks)
+
+
+def shift_sums(sums: dict, offset: float) -> dict:
+    """Сдвинуть начало отсчёта времени сумм МНК: t -> t + offset"""
+    n, sum_t, sum_v = sums["n"], sums["sum_t"], sums["sum_v"]
+    return {"n": n, "sum_t": sum_t + offset * n, "sum_v": sum_v,
+            "sum_tt": sums["sum_tt"] + 2 * offset * sum_t + offset ** 2 * n,
+            "sum_tv": sums["sum_tv"] + offset * sum_v}
+
+
+def merge_sums(*parts: dict) -> dict:
+    """Сложить суммы МНК с общим началом отсчёта времени"""
+    keys = ["n", "sum_t", "sum_v", "sum_tt", "sum_tv"]
+    return {key: sum(part[key] for part in parts) for key in keys}
+
+
+def rollup_operations(collection: str, match: dict, records: list[tuple]) -> dict[str, list]:
+    """Составить обновления минутных и часовых агрегатов
+    для измерений (время, значение) по коллекциям агрегатов"""
+    if not DB_ROLLUPS or len(records) == 0:
+        return {}
+    result = {}
+    for suffix, size in ROLLUP_TIERS:
+        buckets: dict[float, list] = {}
+        for date, value in records:
+            start = math.floor(date.timestamp() / size) * size
+            buckets.setdefault(start, []).append(
+                (date.timestamp() - start, float(value)))
+        operations = []
+        for start, samples in buckets.items():
+            t = np.array([x[0] for x in samples])
+            v = np.array([x[1] for x in samples])
+            operations.append(pymongo.UpdateOne(
+                match | {"date": datetime.datetime.fromtimestamp(start)},
+                {"$inc": {"n": len(v), "sum_v": float(v.sum()),
+                          "sum_vv": float((v * v).sum()),
+                          "sum_t": float(t.sum()),
+                          "sum_tt": float((t * t).sum()),
+                          "sum_tv": float((t * v).sum())},
+                 "$min": {"min": float(v.min())},
+                 "$max": {"max": float(v.max())}},
+                upsert=True))
+        result[f"{collection}_{suffix}"] = operations
+    return result
+
+
+def downsample_lttb(dates: np.ndarray, values: np.ndarray, points: int) -> np.ndarray:
+    """Прореживание ряда методом Largest-Triangle-Three-Buckets.
+    Возвращает индексы сохраняемых точек"""
+    n = len(values)
+    if points >= n or points < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, points - 1).astype(np.int64)
+    selected = np.empty(points, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    for i in range(points - 2):
+        lo, hi = edges[i], max(edges[i + 1], edges[i] + 1)
+        # Опорная точка следующей корзины - её центр масс
+        next_hi = edges[i + 2] if i + 2 < len(edges) else n
+        next_lo = min(hi, next_hi - 1)
+        t_next = dates[next_lo:next_hi].mean()
+        v_next = values[next_lo:next_hi].mean()
+        t_prev, v_prev = dates[selected[i]], values[selected[i]]
+        area = np.abs((t_prev - t_next) * (values[lo:hi] - v_prev) -
+                      (t_prev - dates[lo:hi]) * (v_next - v_prev))
+        selected[i + 1] = lo + np.argmax(area)
+    return selected
+
+
+def downsample_buckets(dates: np.ndarray, values: np.ndarray, points: int):
+    """Прореживание ряда по равным промежуткам времени.
+    Возвращает начало, минимум, среднее и максимум каждой непустой корзины"""
+    if len(values) == 0:
+        return dates, values, values, values
+    edges = np.linspace(dates[0], dates[-1], points + 1)[:-1]
+    starts = np.unique(np.searchsorted(dates, edges, side="left"))
+    counts = np.diff(np.append(starts, len(values)))
+    return (dates[starts],
+            np.minimum.reduceat(values, starts),
+            np.add.reduceat(values, starts) / counts,
+            np.maximum.reduceat(values, starts))
+
+
+class Archive:
+    """Сжатые колоночные архивы измерений на диске: файл .npz на сутки и датчик"""
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def path(self, collection: str, sensor: str, day: datetime.date) -> str:
+        return os.path.join(self.directory, collection, sensor, f"{day.isoformat()}.npz")
+
+    def last_day(self, collection: str, sensor: str) -> datetime.date:
+        """Последние сутки в архиве датчика (None, если архива нет)"""
+        directory = os.path.join(self.directory, collection, sensor)
+        if not os.path.isdir(directory):
+            return None
+        days = [x[:-4] for x in os.listdir(directory) if x.endswith(".npz")]
+        if len(days) == 0:
+            return None
+        return datetime.date.fromisoformat(max(days))
+
+    def write(self, collection: str, sensor: str, day: datetime.date,
+              dates: np.ndarray, values: np.ndarray):
+        path = self.path(collection, sensor, day)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as file:
+            np.savez_compressed(file, date=dates, value=values)
+        os.replace(path + ".tmp", path)
+
+    def read(self, collection: str, sensor: str, begin: datetime.datetime,
+             end: datetime.datetime) -> tuple[np.ndarray, np.ndarray]:
+        """Прочитать время и значения за промежуток [begin, end)"""
+        dates, values = [], []
+        day = begin.date()
+        while day <= end.date():
+            path = self.path(collection, sensor, day)
+            if os.path.exists(path):
+                with np.load(path) as data:
+                    inside = (data["date"] >= begin.timestamp()) & \
+                        (data["date"] < end.timestamp())
+                    dates.append(data["date"][inside])
+                    values.append(data["value"][inside])
+            day += datetime.timedelta(days=1)
+        if len(dates) == 0:
+            return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float64)
+        return np.concatenate(dates), np.concatenate(values)
+
+
 class DatabaseLink:
     """Класс интерфейса базы данных"""
 
-    def __init__(self, host: str, username: str, password: str, database: str) -> None:
+    def __init__(self, host: str, username: str, password: str, database: str,
+                 write_behind: bool = DB_WRITE_BEHIND) -> None:
         self.client = pymongo.MongoClient(
             host=host, username=username, password=password, authSource=database, authMechanism="SCRAM-SHA-256")
         self.db = self.client[database]
         print(f"Connected to database {host}/{database}")
+        if DB_TIMESERIES:
+            self.ensure_timeseries()
+        self.ensure_indexes()
+        self.rollups_since = self.init_rollups()
+        self.archive = None
+        if RETENTION_DAYS is not None and ARCHIVE_DIR is not None:
+            # Сутки архивируются после завершения, не позже чем через ARCHIVE_INTERVAL
+            if RETENTION_DAYS * 86400 <= 86400 + ARCHIVE_INTERVAL:
+                raise ValueError(
+                    "RETENTION_DAYS must exceed one day plus ARCHIVE_INTERVAL")
+            self.archive = Archive(ARCHIVE_DIR)
+        # Без архива измерения удаляются по TTL сразу, иначе - после первого
+        # полного прохода архиватора
+        self.ensure_retention(["log"] if self.archive is not None
+                              else ["log"] + measurement_collections())
+        self.write_behind = write_behind
+        if write_behind:
+            # Записи копятся в очереди и пишутся пачками фоновым потоком.
+            # Заполненная очередь блокирует отправителя
+            self._queue = queue.Queue(maxsize=DB_QUEUE_SIZE)
+            self._pending = 0
+            self._pending_lock = threading.Lock()
+            self._flusher = threading.Thread(
+                target=self._flush_loop, name="db-flusher", daemon=True)
+            self._flusher.start()
+            atexit.register(self.close)
+
+    def ensure_indexes(self):
+        """Создать и проверить индексы, нужные запросам по времени и токенам"""
+        indexes = {collection: [[("date", 1)], [("sensor", 1), ("date", 1)]]
+                   for collection in measurement_collections()}
+        indexes |= {"log": [[("date", 1)]],
+                    "device": [[("token", 1)], [("name", 1)], [("seq", 1)]]}
+        if DB_LAYOUT == "unified":
+            indexes[MEASUREMENT_COLLECTION].append([("kind", 1), ("date", 1)])
+        if DB_ROLLUPS:
+            indexes |= {f"{collection}_{suffix}": [[("date", 1)],
+                                                   [("sensor", 1), ("date", 1)]]
+                        for collection in measurement_collections()
+                        for suffix, _ in ROLLUP_TIERS}
+        for collection, keys in indexes.items():
+            # Индекс по времени может уже быть TTL-индексом с другими параметрами
+            present = [x["key"] for x in
+                       self.db[collection].index_information().values()]
+            for key in keys:
+                if key not in present:
+                    self.db[collection].create_index(key)
+            present = [x["key"] for x in
+                       self.db[collection].index_information().values()]
+            for key in keys:
+                if key not in present:
+                    print(f"Index {key} is missing in {collection}")
+
+    def ensure_retention(self, collections: list[str]):
+        """Удалять старые записи коллекций (сырые измерения, журнал) по TTL"""
+        for collection in collections:
+            count = LOG_RETENTION_DAYS if collection == "log" else RETENTION_DAYS
+            if count is None:
+                continue
+            seconds = int(count * 86400)
+            try:
+                if DB_TIMESERIES and collection != "log":
+                    self.db.command({"collMod": collection,
+                                     "expireAfterSeconds": seconds})
+                else:
+                    # Индекс по времени уже есть: он становится TTL-индексом
+                    self.db.command({"collMod": collection, "index": {
+                        "keyPattern": {"date": 1}, "expireAfterSeconds": seconds}})
+            except pymongo.errors.OperationFailure:
+                self.db[collection].drop_index([("date", 1)])
+                self.db[collection].create_index([("date", 1)],
+                                                 expireAfterSeconds=seconds)
+
+    def retention_cutoff(self) -> datetime.datetime:
+        """Граница, раньше которой сырые измерения есть только в архиве"""
+        return datetime.datetime.now() - datetime.timedelta(days=RETENTION_DAYS)
+
+    def archive_day(self, collection: str, field: str, sensor: str, match: dict,
+                    day: datetime.date) -> int:
+        """Записать сырые измерения датчика за сутки в архив"""
+        begin = datetime.datetime.combine(day, datetime.time())
+        records = self.get_for_period(collection, begin,
+                                      begin + datetime.timedelta(days=1),
+                                      projection={"_id": 0, "date": 1, field: 1},
+                                      match=match, archived=False)
+        if len(records) == 0:
+            return 0
+        self.archive.write(collection, sensor, day,
+                           np.array([x["date"].timestamp() for x in records],
+                                    dtype=np.float64),
+                           np.array([float(x[field]) for x in records],
+                                    dtype=np.float64))
+        return len(records)
+
+    def archived_sensors(self, collection: str, match: dict = None) -> list[str]:
+        """Датчики из фильтра записей, измерения которых архивируются"""
+        if self.archive is None or collection not in measurement_collections():
+            return []
+        sensor = (match or {}).get("sensor")
+        if isinstance(sensor, str):
+            return [sensor]
+        if isinstance(sensor, dict):
+            return list(sensor.get("$in", []))
+        return []
+
+    def read_archive(self, collection: str, begin: datetime.datetime, end: datetime.datetime,
+                     match: dict = None) -> list[dict]:
+        """Получить измерения из архива за (begin, end) в виде записей БД"""
+        field = "value" if collection == MEASUREMENT_COLLECTION else collection
+        kind = (match or {}).get("kind")
+        extra = {"kind": kind} if isinstance(kind, str) else {}
+        records = []
+        for sensor in self.archived_sensors(collection, match):
+            dates, values = self.archive.read(collection, sensor, begin, end)
+            records += [{field: value, "sensor": sensor, "date": datetime.datetime.fromtimestamp(date)} | extra
+                        for date, value in zip(dates.tolist(), values.tolist())
+                        if date > begin.timestamp()]
+        records.sort(key=lambda x: x["date"])
+        return records
+
+    def split_archived(self, collection: str, begin: datetime.datetime, end: datetime.datetime,
+                       match: dict = None) -> datetime.datetime:
+        """Граница между архивом и БД внутри промежутка (None, если архив не нужен)"""
+        if not self.archived_sensors(collection, match):
+            return None
+        cutoff = self.retention_cutoff()
+        if begin >= cutoff:
+            return None
+        return min(cutoff, end)
+
+    def get_first(self, collection: str, match: dict = None) -> datetime.datetime:
+        """Время самой старой записи (None, если записей нет)"""
+        self.flush()
+        record = self.db[collection].find_one(match or {}, sort=[("date", 1)])
+        return None if record is None else record["date"]
+
+    def ensure_timeseries(self):
+        """Хранить измерения в time-series коллекциях MongoDB.
+        Обычные коллекции с данными переносятся в новые"""
+        existing = self.db.list_collection_names()
+        for collection in measurement_collections():
+            legacy = f"{collection}_plain"
+            if collection in existing and \
+                    "timeseries" in self.db[collection].options():
+                if legacy not in existing:
+                    continue
+                # Предыдущий перенос был прерван: он продолжается
+            else:
+                if collection in existing:
+                    self.db[collection].rename(legacy)
+                    existing.append(legacy)
+                self.db.create_collection(collection, timeseries={
+                    "timeField": "date", "metaField": "sensor",
+                    "granularity": "seconds"})
+            if legacy not in existing:
+                continue
+            moved = self.move_records(legacy, collection)
+            self.db[legacy].drop()
+            print(f"Collection {collection} migrated to time-series ({moved} records)")
+
+    def move_records(self, source: str, target: str) -> int:
+        """Перенести записи пачками по времени, удаляя перенесённые из source.
+        Прерванный перенос можно запустить снова без потерь и повторов"""
+        moved = 0
+        while True:
+            batch = list(self.db[source].find({"date": {"$type": "date"}})
+                         .sort([("date", 1), ("_id", 1)]).limit(DB_FLUSH_SIZE))
+            if len(batch) == 0:
+                return moved
+            ids = [x["_id"] for x in batch]
+            # Пачка могла быть записана, но не удалена из source до прерывания
+            copied = {x["_id"] for x in self.db[target].find(
+                {"_id": {"$in": ids},
+                 "date": {"$gte": batch[0]["date"], "$lte": batch[-1]["date"]}},
+                {"_id": 1})}
+            fresh = [x for x in batch if x["_id"] not in copied]
+            if fresh:
+                self.db[target].insert_many(fresh)
+            self.db[source].delete_many({"_id": {"$in": ids}})
+            moved += len(fresh)
+
+    def _enqueue(self, collection: str, operation):
+        with self._pending_lock:
+            self._pending += 1
+        self._queue.put((collection, operation))
+
+    def _flush_loop(self):
+        batch = []
+        deadline = time.monotonic() + DB_FLUSH_INTERVAL
+        while True:
+            try:
+                item = self._queue.get(
+                    timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                item = ()
+            if isinstance(item, threading.Event) or item is None:
+                # Запрос на сброс очереди или остановку
+                self._write(batch)
+                batch = []
+                if item is None:
+                    return
+                item.set()
+                continue
+            if item:
+                batch.append(item)
+            if len(batch) >= DB_FLUSH_SIZE or time.monotonic() >= deadline:
+                self._write(batch)
+                batch = []
+                deadline = time.monotonic() + DB_FLUSH_INTERVAL
+
+    def _write(self, batch: list):
+        if len(batch) == 0:
+            return
+        operations: dict[str, list] = {}
+        for collection, operation in batch:
+            operations.setdefault(collection, []).append(operation)
+        for collection, group in operations.items():
+            try:
+                self.db[collection].bulk_write(group, ordered=True)
+            except pymongo.errors.PyMongoError as error:
+                print(f"Failed to write {len(group)} records to {collection}: {error}")
+        with self._pending_lock:
+            self._pending -= len(batch)
+
+    def flush(self):
+        """Дождаться записи всех отложенных операций"""
+        if not self.write_behind or not self._flusher.is_alive():
+            return
+        with self._pending_lock:
+            if self._pending == 0:
+                return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        """Записать отложенные операции и остановить фоновый поток"""
+        if self.write_behind and self._flusher.is_alive():
+            self._queue.put(None)
+            self._flusher.join()
 
     def send(self, collection: str, value: dict):
         """Создать запись в БД"""
         value |= {"date": datetime.datetime.now(
         )}  # Время записи добавляется автоматически
+        if self.write_behind:
+            self._enqueue(collection, pymongo.InsertOne(value))
+            return
         self.db[collection].insert_one(value)
 
+    def send_many(self, collection: str, values: list[dict]):
+        """Создать несколько записей в БД одним запросом"""
+        now = datetime.datetime.now()
+        for value in values:
+            if value.get("date") is None:
+                value["date"] = now
+        if self.write_behind:
+            for value in values:
+                self._enqueue(collection, pymongo.InsertOne(value))
+            return
+        self.db[collection].insert_many(values, ordered=False)
+
     def update(self, collection: str, record: dict, subs: dict):
+        if self.write_behind:
+            self._enqueue(collection, pymongo.UpdateOne(
+                record, {"$set": subs}))
+            return
         self.db[collection].update_one(record, {"$set": subs})
 
-    def get(self, collection: str):
+    def next_seq(self, name: str) -> int:
+        """Получить следующий номер общего для всех процессов счётчика"""
+        record = self.db["counters"].find_one_and_update(
+            {"_id": name}, {"$inc": {"seq": 1}}, upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER)
+        return record["seq"]
+
+    def update_token(self, name: str, token):
+        """Изменить токен датчика, пометив изменение номером для других процессов"""
+        self.flush()
+        self.db["device"].update_many(
+            {"name": name}, {"$set": {"token": token, "seq": self.next_seq("device")}})
+
+    def get_token_changes(self, seq: int) -> list:
+        """Получить изменения токенов с номером больше seq"""
+        self.flush()
+        return list(self.db["device"].find({"seq": {"$gt": seq}}, {"_id": 0})
+                    .sort("seq", pymongo.ASCENDING))
+
+    def init_state(self, name: str, state: dict) -> tuple[dict, bool]:
+        """Создать общее состояние помещения, если его ещё нет, и получить его.
+        Второе значение - создано ли состояние этим вызовом"""
+        state = state | {"version": 1}
+        previous = self.db["state"].find_one_and_update(
+            {"_id": name}, {"$setOnInsert": state}, upsert=True,
+            return_document=pymongo.ReturnDocument.BEFORE)
+        if previous is None:
+            return {"_id": name} | state, True
+        return previous, False
+
+    def update_state(self, name: str, subs: dict) -> dict:
+        """Изменить общее состояние помещения с увеличением версии"""
+        return self.db["state"].find_one_and_update(
+            {"_id": name}, {"$set": subs, "$inc": {"version": 1}}, upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER)
+
+    def get_state(self, name: str) -> dict:
+        return self.db["state"].find_one({"_id": name})
+
+    def get_state_version(self, name: str) -> int:
+        record = self.db["state"].find_one({"_id": name}, {"version": 1})
+        return 0 if record is None else record["version"]
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """Занять или продлить аренду, если она свободна, истекла или уже своя"""
+        now = datetime.datetime.now()
+        try:
+            self.db["leases"].find_one_and_update(
+                {"_id": name, "$or": [{"owner": owner}, {"expires": {"$lt": now}}]},
+                {"$set": {"owner": owner,
+                          "expires": now + datetime.timedelta(seconds=ttl)}},
+                upsert=True)
+        except pymongo.errors.DuplicateKeyError:
+            # Аренду держит другой процесс
+            return False
+        return True
+
+    def watch_tokens(self, timeout: float):
+        """Поток изменений коллекции устройств (нужен набор реплик)"""
+        return self.db["device"].watch(max_await_time_ms=int(timeout * 1000))
+
+    def get(self, collection: str, match: dict = None):
         """Получить записи в БД"""
-        return list(self.db[collection].find().sort({"date": 1}))
+        self.flush()
+        return list(self.db[collection].find(match or {}).sort({"date": 1}))
 
     def check_exist(self, collection, field, value):
+        self.flush()
         cursor = self.db[collection].find_one({field: value})
         if cursor == None:
             return False
@@ -47,56 +687,527 @@ class DatabaseLink:
             return False
         return True
 
-    def get_for_period(self, collection: str, begin: datetime.datetime, end: datetime.datetime = datetime.datetime.now()):
-        """Получить записи в БД за данный промежуток времени"""
-        return list(self.db[collection].find({"date": {"$gt": begin, "$lt": end}}).sort({"date": 1}))
-
-
-class Sensor(abc.ABC):
-    """АБК датчика"""
-
-    pragma: str = None
-
-    @abc.abstractmethod
-    def __init__(self, name, token, db: DatabaseLink):
+    def get_for_period(self, collection: str, begin: datetime.datetime, end: datetime.datetime = datetime.datetime.now(),
+                       projection: dict = None, match: dict = None, archived: bool = True):
+        """Получить записи в БД за данный промежуток времени.
+        Измерения, удалённые по сроку хранения, читаются из архива"""
+        records = []
+        cutoff = self.split_archived(collection, begin, end, match) if archived else None
+        if cutoff is not None:
+            records = self.read_archive(collection, begin, cutoff, match)
+            begin = cutoff
+        self.flush()
+        return records + list(self.db[collection].find({"date": {"$gt": begin, "$lt": end}} | (match or {}), projection).sort({"date": 1}))
+
+    def iter_for_period(self, collection: str, begin: datetime.datetime, end: datetime.datetime,
+                        projection: dict = None, batch_size: int = EXPORT_BATCH_SIZE, match: dict = None):
+        """Перебрать записи за промежуток времени прямо из курсора БД
+        (более старые, чем срок хранения, - из архива)"""
+        cutoff = self.split_archived(collection, begin, end, match)
+        if cutoff is not None:
+            yield from self.read_archive(collection, begin, cutoff, match)
+            begin = cutoff
+        self.flush()
+        cursor = self.db[collection].find(
+            {"date": {"$gt": begin, "$lt": end}} | (match or {}), projection).sort({"date": 1}).batch_size(batch_size)
+        with cursor:
+            yield from cursor
+
+    def get_regression_sums(self, collection: str, field: str, begin: datetime.datetime, end: datetime.datetime,
+                            inclusive: bool = False, match: dict = None, group: str = None):
+        """Получить суммы для среднего и МНК за промежуток одним запросом.
+        Время в секундах отсчитывается от begin.
+        С group - словарь сумм по значениям этого поля записей"""
+        projection = {"t": {"$divide": [{"$subtract": ["$date", begin]}, 1000]},
+                      "v": f"${field}"}
+        if group is not None:
+            projection["g"] = f"${group}"
+        pipeline = [
+            {"$match": {"date": {"$gte" if inclusive else "$gt": begin,
+                                 "$lt": end}} | (match or {})},
+            {"$project": projection},
+            {"$group": {
+                "_id": None if group is None else "$g",
+                "n": {"$sum": 1},
+                "sum_t": {"$sum": "$t"},
+                "sum_v": {"$sum": "$v"},
+                "sum_tt": {"$sum": {"$multiply": ["$t", "$t"]}},
+                "sum_tv": {"$sum": {"$multiply": ["$t", "$v"]}}}},
+        ]
+        self.flush()
+        result = list(self.db[collection].aggregate(pipeline))
+        if group is not None:
+            return {x.pop("_id"): x for x in result}
+        if len(result) == 0:
+            return {"n": 0, "sum_t": 0, "sum_v": 0, "sum_tt": 0, "sum_tv": 0}
+        return result[0]
+
+    def get_raw_sums(self, collection: str, field: str, begin: datetime.datetime, end: datetime.datetime,
+                     inclusive: bool = False, match: dict = None):
+        """Суммы для среднего и МНК по сырым измерениям с учётом архива.
+        Время в секундах отсчитывается от begin"""
+        cutoff = self.split_archived(collection, begin, end, match)
+        if cutoff is None:
+            return self.get_regression_sums(collection, field, begin, end,
+                                            inclusive, match)
+        sensor = self.archived_sensors(collection, match)[0]
+        dates, values = self.archive.read(collection, sensor, begin, cutoff)
+        if not inclusive:
+            newer = dates > begin.timestamp()
+            dates, values = dates[newer], values[newer]
+        t = dates - begin.timestamp()
+        archived = {"n": len(values), "sum_t": float(t.sum()), "sum_v": float(values.sum()),
+                    "sum_tt": float((t * t).sum()), "sum_tv": float((t * values).sum())}
+        if cutoff >= end:
+            return archived
+        recent = self.get_regression_sums(collection, field, cutoff, end,
+                                          inclusive=True, match=match)
+        return merge_sums(archived, shift_sums(recent, cutoff.timestamp() - begin.timestamp()))
+
+    def update_rollups(self, collection: str, match: dict, records: list[tuple]):
+        """Учесть измерения (время, значение) в минутных и часовых агрегатах"""
+        for name, operations in rollup_operations(collection, match, records).items():
+            if self.write_behind:
+                for operation in operations:
+                    self._enqueue(name, operation)
+            else:
+                self.db[name].bulk_write(operations)
+
+    def init_rollups(self) -> dict[str, float]:
+        """Отметить момент, с которого агрегаты коллекций учитывают все измерения.
+        Агрегаты пишутся только для новых измерений, и более ранние окна
+        читаются из сырых измерений"""
+        if not DB_ROLLUPS:
+            # Агрегаты перестают обновляться: после включения они начнутся заново
+            self.db["rollups"].delete_many({})
+            return {}
+        now = datetime.datetime.now()
+        return {collection: self.db["rollups"].find_one_and_update(
+            {"_id": collection}, {"$setOnInsert": {"since": now}}, upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER)["since"].timestamp()
+            for collection in measurement_collections()}
+
+    def rollup_start(self, collection: str, size: int) -> float:
+        """Начало первой полной корзины агрегатов коллекции [s эпохи]"""
+        since = self.rollups_since.get(collection)
+        if since is None:
+            return math.inf
+        return math.ceil(since / size) * size
+
+    def choose_rollup(self, period: datetime.timedelta):
+        """Выбрать самый грубый уровень агрегатов, подходящий для окна"""
+        if not DB_ROLLUPS:
+            return None
+        tier = None
+        for suffix, size in ROLLUP_TIERS:
+            if period.total_seconds() >= size * ROLLUP_MIN_BUCKETS:
+                tier = (suffix, size)
+        return tier
+
+    def get_rollups(self, collection: str, suffix: str, begin: datetime.datetime, end: datetime.datetime,
+                    match: dict = None):
+        """Получить агрегаты, начинающиеся в промежутке [begin, end)"""
+        self.flush()
+        return list(self.db[f"{collection}_{suffix}"].find(
+            {"date": {"$gte": begin, "$lt": end}} | (match or {})).sort({"date": 1}))
+
+    def get_window_sums(self, collection: str, field: str, begin: datetime.datetime, end: datetime.datetime,
+                        match: dict = None):
+        """Получить суммы для среднего и МНК за промежуток.
+        Длинные окна считаются по агрегатам, а края окна - по измерениям"""
+        tier = self.choose_rollup(end - begin)
+        if tier is None:
+            return self.get_raw_sums(collection, field, begin, end,
+                                     match=match)
+        suffix, size = tier
+        # До начала агрегатов суммы считаются по измерениям, как края окна
+        first = max(math.ceil(begin.timestamp() / size) * size,
+                    self.rollup_start(collection, size))
+        last = math.floor(end.timestamp() / size) * size
+        if last <= first:
+            return self.get_raw_sums(collection, field, begin, end,
+                                     match=match)
+        head = self.get_raw_sums(
+            collection, field, begin, datetime.datetime.fromtimestamp(first),
+            match=match)
+        tail = self.get_raw_sums(
+            collection, field, datetime.datetime.fromtimestamp(last), end,
+            inclusive=True, match=match)
+        parts = [head, shift_sums(tail, last - begin.timestamp())]
+        for bucket in self.get_rollups(collection, suffix,
+                                       datetime.datetime.fromtimestamp(first),
+                                       datetime.datetime.fromtimestamp(last),
+                                       match):
+            parts.append(shift_sums(
+                bucket, bucket["date"].timestamp() - begin.timestamp()))
+        return merge_sums(*parts)
+
+    def get_last(self, collection: str, count: int, match: dict = None):
+        """Получить последние записи в БД (от новых к старым)"""
+        self.flush()
+        return list(self.db[collection].find(match or {}).sort({"date": -1}).limit(count))
+
+
+class RingBuffer:
+    """Кольцевой буфер последних измерений (время, значение)"""
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self._dates = np.zeros(capacity, dtype=np.float64)
+        self._values = np.zeros(capacity, dtype=np.float64)
+        self._start = 0
+        self._size = 0
+        self._lock = threading.Lock()
+        # Записи не позже этого момента могли быть вытеснены из буфера.
+        # До первой загрузки из БД буфер ничего не покрывает
+        self.complete_since = np.inf
+
+    def __len__(self):
+        return self._size
+
+    def append(self, date: float, value: float):
+        """Добавить измерение, вытеснив самое старое при переполнении"""
+        with self._lock:
+            self._append(date, value)
+
+    def _append(self, date: float, value: float):
+        if date <= self.complete_since:
+            # Это время уже вытеснено из буфера и читается из БД
+            return
+        if self._size and date < self._dates[(self._start + self._size - 1) % self.capacity]:
+            self._insert(date, value)
+            return
+        if self._size == self.capacity:
+            self.complete_since = self._dates[self._start]
+            self._start = (self._start + 1) % self.capacity
+            self._size -= 1
+        index = (self._start + self._size) % self.capacity
+        self._dates[index] = date
+        self._values[index] = value
+        self._size += 1
+
+    def _insert(self, date: float, value: float):
+        """Вставить измерение не по порядку (пакет с временем блока датчика)"""
+        order = (self._start + np.arange(self._size)) % self.capacity
+        dates = self._dates[order]
+        values = self._values[order]
+        index = np.searchsorted(dates, date, side="right")
+        dates = np.insert(dates, index, date)
+        values = np.insert(values, index, value)
+        if len(dates) > self.capacity:
+            self.complete_since = dates[0]
+            dates, values = dates[1:], values[1:]
+        self._start = 0
+        self._size = len(dates)
+        self._dates[:self._size] = dates
+        self._values[:self._size] = values
+
+    def load(self, dates, values, complete_since: float = -np.inf):
+        """Заполнить буфер из БД (записи от старых к новым).
+        complete_since - момент, раньше которого записи БД могут быть неполны"""
+        with self._lock:
+            self._start = 0
+            self._size = 0
+            self.complete_since = complete_since
+            for date, value in zip(dates, values):
+                self._append(date, value)
+            if len(dates) >= self.capacity:
+                # В БД могут быть записи старше загруженных
+                self.complete_since = self._dates[self._start]
+
+    def covers(self, begin: float) -> bool:
+        """Все ли записи после begin находятся в буфере"""
+        return begin >= self.complete_since
+
+    def get_for_period(self, begin: float, end: float):
+        """Получить измерения в интервале (begin, end)"""
+        with self._lock:
+            stop = self._start + self._size
+            if stop <= self.capacity:
+                segments = [slice(self._start, stop)]
+            else:
+                segments = [slice(self._start, self.capacity),
+                            slice(0, stop - self.capacity)]
+            dates, values = [], []
+            for segment in segments:
+                chunk = self._dates[segment]
+                lo = np.searchsorted(chunk, begin, side="right")
+                hi = np.searchsorted(chunk, end, side="left")
+                dates.append(chunk[lo:hi].copy())
+                values.append(self._values[segment][lo:hi].copy())
+            return np.concatenate(dates), np.concatenate(values)
+
+
+class TrendEstimator:
+    """Скользящий МНК по окну фиксированной длительности.
+    Добавление измерения и чтение тренда выполняются за O(1)"""
+
+    def __init__(self, window: float) -> None:
+        self.window = window  # [s]
+        self._samples = collections.deque()
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # Время отсчитывается от самого старого измерения в окне,
+        # поэтому суммы не содержат огромных секунд эпохи
+        self._origin = self._samples[0][0] if self._samples else None
+        self._evicted = 0
+        self._sum_t = self._sum_v = self._sum_tt = self._sum_tv = 0.0
+        for date, value in self._samples:
+            self._accumulate(date - self._origin, value, 1)
+
+    def _accumulate(self, t, value, sign):
+        self._sum_t += sign * t
+        self._sum_v += sign * value
+        self._sum_tt += sign * t * t
+        self._sum_tv += sign * t * value
+
+    def load(self, dates, values):
+        """Заполнить окно измерениями (от старых к новым)"""
+        with self._lock:
+            self._samples = collections.deque(zip(dates, values))
+            self._reset()
+
+    def add(self, date: float, value: float):
+        """Добавить измерение"""
+        with self._lock:
+            if self._origin is None:
+                self._origin = date
+            if self._samples and date < self._samples[-1][0]:
+                bisect.insort(self._samples, (date, value))
+            else:
+                self._samples.append((date, value))
+            self._accumulate(date - self._origin, value, 1)
+            # Окно ограничено и без чтений тренда
+            self._evict(self._samples[-1][0])
+
+    def _evict(self, now: float):
+        cutoff = now - self.window
+        while self._samples and self._samples[0][0] <= cutoff:
+            date, value = self._samples.popleft()
+            self._accumulate(date - self._origin, value, -1)
+            self._evicted += 1
+        # Пересчёт сумм гасит накопленную ошибку вычитаний;
+        # он выполняется раз в len(окна) вытеснений, то есть за O(1) в среднем
+        if self._evicted > len(self._samples):
+            self._reset()
+
+    def get(self, now: float):
+        """Получить число измерений, среднее и тренд в окне на момент now"""
+        with self._lock:
+            self._evict(now)
+            n = len(self._samples)
+            if n == 0:
+                return (0, None, 0.0)
+            mean_t = self._sum_t / n
+            average = self._sum_v / n
+            s_tt = self._sum_tt - mean_t * self._sum_t
+            s_tv = self._sum_tv - mean_t * self._sum_v
+            trend = s_tv / s_tt if n > 1 and s_tt > 0 else 0.0
+            return (n, average, trend)
+
+
+class Sensor:
+    """Класс датчика. Тип измерения (pragma) задаёт SENSOR_KINDS"""
+
+    room: str = None
+    # Время последней записи измерений [s эпохи]
+    modified: float = 0.0
+
+    def __init__(self, name, token, db: DatabaseLink, pragma: str):
+        self.pragma = pragma
+        self.kind: SensorKind = SENSOR_KINDS[pragma]
         self.name = name
         self._token = token
         self.db = db
+        # Измерения разных помещений лежат в общих коллекциях
+        if DB_LAYOUT == "unified":
+            self.collection = MEASUREMENT_COLLECTION
+            self.field = "value"
+            self.scope = {"kind": self.pragma, "sensor": name}
+        else:
+            self.collection = self.pragma
+            self.field = self.pragma
+            self.scope = {"sensor": name}
         if not (db.check_exist("device", "name", name) and db.check_exist("device", "token", token)):
             self.db.send("device", {"name": name,
                                     "token": token, "pragma": self.pragma})
+        self.buffer = RingBuffer(SENSOR_BUFFER_SIZE)
+        self.estimator = TrendEstimator(env.PERIOD_REPORT * 60)
+        self._listeners = []
+        if SENSOR_BUFFER_AUTHORITATIVE:
+            self.load_buffer()
+
+    def add_listener(self, callback):
+        """Подписаться на сохранение новых измерений.
+        Подписчик получает датчик и список сохранённых записей"""
+        self._listeners.append(callback)
+
+    def _notify(self, records: list[dict]):
+        # Измерения уже записаны: ошибка подписчика не должна сорвать приём
+        for callback in self._listeners:
+            try:
+                callback(self, records)
+            except Exception as error:
+                print(f"Listener of {self.name} failed: {error}")
+
+    def load_buffer(self):
+        """Загрузить последние измерения из БД в буфер"""
+        records = self.db.get_last(
+            self.collection, self.buffer.capacity, self.scope)[::-1]
+        # Измерения старше срока хранения могут быть только в архиве
+        complete_since = -np.inf
+        if RETENTION_DAYS is not None:
+            complete_since = self.db.retention_cutoff().timestamp()
+        self.buffer.load([x["date"].timestamp() for x in records],
+                         [float(x[self.field]) for x in records], complete_since)
+        if len(records) > 0:
+            self.modified = records[-1]["date"].timestamp()
+        dates, values = self.get_for_period(
+            datetime.timedelta(seconds=self.estimator.window))
+        self.estimator.load(dates, values)
+
+    def get_for_period(self, period: datetime.timedelta):
+        """Получить время и значения измерений за период"""
+        end = datetime.datetime.now()
+        begin = end - period
+        if SENSOR_BUFFER_AUTHORITATIVE and self.buffer.covers(begin.timestamp()):
+            return self.buffer.get_for_period(begin.timestamp(), end.timestamp())
+        tier = self.db.choose_rollup(period)
+        if tier is not None and \
+                begin.timestamp() >= self.db.rollup_start(self.collection, tier[1]):
+            # Длинный период отдаётся средними по корзинам агрегатов.
+            # Агрегаты не удаляются по сроку хранения и покрывают и архив
+            records = self.db.get_rollups(
+                self.collection, tier[0], begin, end, self.scope)
+            dates = np.array([x["date"].timestamp() for x in records],
+                             dtype=np.float64)
+            values = np.array([x["sum_v"] / x["n"] for x in records],
+                              dtype=np.float64)
+            return dates, values
+        # Измерения старше срока хранения БД дочитывает из архива
+        records = self.db.get_for_period(
+            self.collection, begin, end, match=self.scope)
+        dates = np.array([x["date"].timestamp() for x in records],
+                         dtype=np.float64)
+        values = np.array([float(x[self.field]) for x in records],
+                          dtype=np.float64)
+        return dates, values
+
+    def archive(self):
+        """Перенести в архив завершённые сутки, которых там ещё нет"""
+        last = self.db.archive.last_day(self.collection, self.name)
+        if last is None:
+            first = self.db.get_first(self.collection, self.scope)
+            if first is None:
+                return
+            day = first.date()
+        else:
+            day = last + datetime.timedelta(days=1)
+        while day < datetime.date.today():
+            count = self.db.archive_day(self.collection, self.field,
+                                        self.name, self.scope, day)
+            if count:
+                print(f"Archived {count} records of {self.name} for {day}")
+            day += datetime.timedelta(days=1)
+
+    def get_statistics(self, period: datetime.timedelta, period_forecast: datetime.timedelta):
+        """Получить среднее, тренд и прогноз за один проход по данным"""
+        end = datetime.datetime.now()
+        begin = end - period
+        # Без SENSOR_BUFFER_AUTHORITATIVE измерения других процессов есть только в БД
+        if SENSOR_BUFFER_AUTHORITATIVE and period.total_seconds() == self.estimator.window:
+            n, average, trend = self.estimator.get(end.timestamp())
+            if n == 0:
+                return (None, 0.0, None)
+        elif SENSOR_BUFFER_AUTHORITATIVE and self.buffer.covers(begin.timestamp()):
+            dates, values = self.buffer.get_for_period(
+                begin.timestamp(), end.timestamp())
+            if len(values) == 0:
+                return (None, 0.0, None)
+            average = float(np.mean(values))
+            trend = quick_lstsq(values, dates)[0]
+        else:
+            return statistics_from_sums(self.db.get_window_sums(
+                self.collection, self.field, begin, end, self.scope), period_forecast)
+        forecast = trend * period_forecast.seconds + average
+        return (average, trend, forecast)
 
-    @abc.abstractmethod
     def redefinition_token(self, token):
         """Изменить токен авторизации"""
-        self.db.update("device", {"name": self.name}, {"token": token})
+        self.db.update_token(self.name, token)
         self._token = token
 
-    @abc.abstractmethod
     def remove_token(self):
         """Отозвать токен авторизации"""
-        self.db.update("device", {"name": self.name}, {"token": None})
+        self.db.update_token(self.name, None)
         self._token = None
 
-    @abc.abstractmethod
+    def make_record(self, data, date: datetime.datetime = None) -> dict:
+        """Составить запись измерения для текущей схемы хранения"""
+        record = {self.field: data, "sensor": self.name}
+        if DB_LAYOUT == "unified":
+            record |= {"room": self.room, "kind": self.pragma}
+        if date is not None:
+            record["date"] = date
+        return record
+
     def validate(self, data) -> bool:
         """Утвердить данные"""
+        return self.kind.validate(data)
 
-    @abc.abstractmethod
     def save(self, data):
         """Сохранить данные в БД"""
-
-    @abc.abstractmethod
-    def get_average(self) -> float:
+        if self.validate(data):
+            record = self.make_record(data)
+            self.db.send(self.collection, record)
+            self.db.update_rollups(
+                self.collection, self.scope, [(record["date"], data)])
+            self.remember([record])
+
+    def save_many(self, data: list, dates: list[datetime.datetime]) -> list[bool]:
+        """Сохранить пакет измерений в БД одним запросом"""
+        accepted, records = self.make_records(data, dates)
+        if len(records) == 0:
+            return accepted
+        self.db.send_many(self.collection, records)
+        self.db.update_rollups(self.collection, self.scope,
+                               [(x["date"], x[self.field]) for x in records])
+        self.remember(records)
+        return accepted
+
+    def make_records(self, data: list, dates: list[datetime.datetime]) -> tuple[list[bool], list[dict]]:
+        """Проверить измерения и составить записи для принятых"""
+        now = datetime.datetime.now()
+        accepted = [self.validate(x) for x in data]
+        records = [self.make_record(x, date or now)
+                   for x, date, ok in zip(data, dates, accepted) if ok]
+        return accepted, records
+
+    def remember(self, records: list[dict]):
+        """Учесть сохранённые записи в буфере и оценке тренда"""
+        for record in sorted(records, key=lambda x: x["date"]):
+            self.buffer.append(record["date"].timestamp(),
+                               float(record[self.field]))
+            if SENSOR_BUFFER_AUTHORITATIVE:
+                # Иначе статистика считается по БД и оценка не используется
+                self.estimator.add(record["date"].timestamp(),
+                                   float(record[self.field]))
+        self.modified = time.time()
+        self._notify(records)
+
+    def get_average(self, period) -> float:
         """Получить последнее значение за период"""
+        return self.get_statistics(period, datetime.timedelta(0))[0]
 
-    @abc.abstractmethod
     def get_trend(self, period) -> float:
         """Получить производную по времени"""
+        return self.get_statistics(period, datetime.timedelta(0))[1]
 
-    @abc.abstractmethod
     def get_forecast(self, period, period_forecast):
         """Получить прогноз на заданный промежуток времени"""
+        return self.get_statistics(period, period_forecast)[2]
 
 
 class Executor:
@@ -109,16 +1220,33 @@ class Executor:
         self.address = address
         self.token = _token
         self._db = _db
+        # Соединение с ИУ переиспользуется между командами (keep-alive)
+        self._session = requests.Session()
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """Подписаться на изменение состояния ИУ"""
+        self._listeners.append(callback)
+
+    def _notify(self):
+        # Команда уже отправлена: ошибка подписчика не должна её сорвать
+        for callback in self._listeners:
+            try:
+                callback(self)
+            except Exception as error:
+                print(f"Listener of {self.name} failed: {error}")
 
     def redefinition_token(self, token):
         """Изменить токен авторизации"""
         self.token = token
         print(f"Token of {self.name} changed")
+        self._notify()
 
     def redefinition_address(self, address):
         """Изменить сетевой адрес"""
         self.address = address
         print(f"Net address of {self.name} changed to {address}")
+        self._notify()
 
     def log_event(self, value: dict):
         self._db.send("log", {"executor": self.name,
@@ -127,8 +1255,8 @@ class Executor:
     def send_command(self, value: dict):
         """Отправить команду на ИУ"""
         try:
-            res = requests.post(self.address, json=value,
-                                headers={"Auth": self.token}, timeout=1.5)
+            res = self._session.post(self.address, json=value,
+                                     headers={"Auth": self.token}, timeout=1.5)
             res = res.json()
         except:
             res = {"error": "timeout"}
@@ -136,8 +1264,13 @@ class Executor:
 
     def switch_power(self, power: bool):
         res = self.send_command({"switch_power": power})
+        self.record_power(power, res)
+
+    def record_power(self, power: bool, answer: dict):
+        """Учесть ответ ИУ на команду включения"""
         self._power_status = power
-        self.log_event({"command": {"switch_power": power}, "answer": res})
+        self.log_event({"command": {"switch_power": power}, "answer": answer})
+        self._notify()
 
     def get_power_status(self):
         return self._power_status
@@ -146,284 +1279,107 @@ class Executor:
         return self.settings
 
 
-class TemperatureSensor(Sensor):
-    """Класс датчика температуры"""
-
-    pragma = "temperature"
-
-    def __init__(self, name, token, db: DatabaseLink):
-        super().__init__(name, token, db)
-
-    def validate(self, data) -> bool:
-        if data == None:
-            return False
-        return data < 100 and data > -60
-
-    def save(self, data):
-        if self.validate(data):
-            self.db.send("temperature", {
-                         "temperature": data, "sensor": self.name})
-
-    def get_average(self, period: datetime.timedelta):
-        records = self.db.get_for_period(
-            "temperature", datetime.datetime.now() - period, datetime.datetime.now())
-        try:
-            len(records) > 0
-        except:
-            IndexError
-        values = [float(x["temperature"]) for x in records]
-        try:
-            average = sum(values)/len(values)
-        except:
-            ZeroDivisionError
-            average = None
-        return average
-
-    def get_trend(self, period: datetime.timedelta):
-        records = self.db.get_for_period(
-            "temperature", datetime.datetime.now() - period, datetime.datetime.now())
-        try:
-            len(records) > 0
-        except:
-            IndexError
-        values = [float(x["temperature"]) for x in records]
-        dates = [x["date"] for x in records]
-        return quick_lstsq(values, dates)[0]
-
-    def get_forecast(self, period: datetime.datetime, period_forecast: datetime.timedelta):
-        average = self.get_average(period)
-        trend = self.get_trend(period)
-        forecast = trend * period_forecast.seconds + average
-        return forecast
-
-    def redefinition_token(self, token):
-        return super().redefinition_token(token)
-
-    def remove_token(self):
-        return super().remove_token()
-
-
-class HumiditySensor(Sensor):
-    """Класс датчика влажности"""
-    pragma = "humidity"
-
-    def __init__(self, name, token, db: DatabaseLink):
-        super().__init__(name, token, db)
-
-    def validate(self, data) -> bool:
-        if data == None:
-            return False
-        return data < 100 and data > 0
-
-    def save(self, data):
-        if self.validate(data):
-            self.db.send("humidity", {"humidity": data, "sensor": self.name})
-
-    def get_average(self, period: datetime.datetime):
-        records = self.db.get_for_period(
-            "humidity", datetime.datetime.now()-period, datetime.datetime.now())
-        try:
-            len(records) > 0
-        except:
-            IndexError
-        values = [float(x["humidity"]) for x in records]
-        try:
-            average = sum(values)/len(values)
-        except:
-            ZeroDivisionError
-            average = None
-        return average
-
-    def get_trend(self, period: datetime.datetime):
-        records = self.db.get_for_period(
-            "humidity", datetime.datetime.now()-period, datetime.datetime.now())
-        try:
-            len(records) > 0
-        except:
-            IndexError
-        values = [float(x["humidity"]) for x in records]
-        dates = [x["date"] for x in records]
-        return quick_lstsq(values, dates)[0]
-
-    def get_forecast(self, period: datetime.datetime, period_forecast: datetime.timedelta):
-        average = self.get_average(period)
-        trend = self.get_trend(period)
-        forecast = trend * period_forecast.seconds + average
-        return forecast
-
-    def redefinition_token(self, token):
-        return super().redefinition_token(token)
-
-    def remove_token(self):
-        return super().remove_token()
-
-
-class TemperatureSensorOuter(Sensor):
-    """Класс датчика температуры"""
-
-    pragma = "temperature_outer"
-
-    def __init__(self, name, token, db: DatabaseLink):
-        super().__init__(name, token, db)
-
-    def validate(self, data) -> bool:
-        if data == None:
-            return False
-        return data < 100 and data > -60
-
-    def save(self, data):
-        if self.validate(data):
-            self.db.send("temperature_outer", {
-                "temperature_outer": data, "sensor": self.name})
-
-    def get_average(self, period):
-        records = self.db.get_for_period(
-            "temperature_outer", datetime.datetime.now()-period, datetime.datetime.now())
-        try:
-            len(records) > 0
-        except:
-            IndexError
-        values = [float(x["temperature_outer"]) for x in records]
-        try:
-            average = sum(values)/len(values)
-        except:
-            ZeroDivisionError
-            average = None
-        return average
-
-    def get_trend(self, period):
-        records = self.db.get_for_period(
-            "temperature_outer", datetime.datetime.now()-period, datetime.datetime.now())
-        try:
-            len(records) > 0
-        except:
-            IndexError
-        values = [float(x["temperature_outer"]) for x in records]
-        dates = [x["date"] for x in records]
-        return quick_lstsq(values, dates)[0]
-
-    def get_forecast(self, period: datetime.datetime, period_forecast: datetime.timedelta):
-        average = self.get_average(period)
-        trend = self.get_trend(period)
-        forecast = trend * period_forecast.seconds + average
-        return forecast
-
-    def redefinition_token(self, token):
-        return super().redefinition_token(token)
-
-    def remove_token(self):
-        return super().remove_token()
-
-
-class HumiditySensorOuter(Sensor):
-    """Класс датчика влажности"""
-    pragma = "humidity_outer"
-
-    def __init__(self, name, token, db: DatabaseLink):
-        super().__init__(name, token, db)
-
-    def validate(self, data) -> bool:
-        if data == None:
-            return False
-        return data < 100 and data > 0
-
-    def save(self, data):
-        if self.validate(data):
-            self.db.send("humidity_outer", {
-                "humidity_outer": data, "sensor": self.name})
-
-    def get_average(self, period: datetime.datetime):
-        records = self.db.get_for_period(
-            "humidity_outer", datetime.datetime.now()-period, datetime.datetime.now())
-        try:
-            len(records) > 0
-        except:
-            IndexError
-        values = [float(x["humidity_outer"]) for x in records]
-        try:
-            average = sum(values)/len(values)
-        except:
-            ZeroDivisionError
-            average = None
-        return average
-
-    def get_trend(self, period: datetime.datetime):
-        records = self.db.get_for_period(
-            "humidity_outer", datetime.datetime.now()-period, datetime.datetime.now())
-        try:
-            len(records) > 0
-        except:
-            IndexError
-        values = [float(x["humidity_outer"]) for x in records]
-        dates = [x["date"] for x in records]
-        return quick_lstsq(values, dates)[0]
-
-    def get_forecast(self, period: datetime.datetime, period_forecast: datetime.timedelta):
-        average = self.get_average(period)
-        trend = self.get_trend(period)
-        forecast = trend * period_forecast.seconds + average
-        return forecast
-
-    def redefinition_token(self, token):
-        return super().redefinition_token(token)
-
-    def remove_token(self):
-        return super().remove_token()
-
-
-class CO2Sensor(Sensor):
-    """Класс датчика давления"""
-    pragma = "co2"
-
-    def __init__(self, name, token, db: DatabaseLink):
-        super().__init__(name, token, db)
-
-    def validate(self, data) -> bool:
-        if data == None:
-            return False
-        return data < 100e3 and data > 0
-
-    def save(self, data):
-        if self.validate(data):
-            self.db.send("co2", {"co2": data, "sensor": self.name})
-
-    def get_average(self, period):
-        records = self.db.get_for_period(
-            "co2", datetime.datetime.now()-period, datetime.datetime.now())
-        try:
-            len(records) > 0
-        except:
-            IndexError
-        values = [float(x["co2"]) for x in records]
-        try:
-            average = sum(values)/len(values)
-        except:
-            ZeroDivisionError
-            average = None
-        return average
-
-    def get_trend(self, period):
-        records = self.db.get_for_period(
-            "co2", datetime.datetime.now()-period, datetime.datetime.now())
-        try:
-            len(records) > 0
-        except:
-            IndexError
-        values = [float(x["co2"]) for x in records]
-        dates = [x["date"] for x in records]
-        return quick_lstsq(values, dates)[0]
-
-    def get_forecast(self, period: datetime.datetime, period_forecast: datetime.timedelta):
-        average = self.get_average(period)
-        trend = self.get_trend(period)
-        forecast = trend * period_forecast.seconds + average
-        return forecast
-
-    def redefinition_token(self, token):
-        return super().redefinition_token(token)
-
-    def remove_token(self):
-        return super().remove_token()
+class Broadcaster:
+    """Рассылка событий подписчикам по каналам (помещениям).
+    Событие кодируется один раз и кладётся в очередь каждого подписчика"""
+
+    def __init__(self, queue_size: int = STREAM_QUEUE_SIZE) -> None:
+        self.queue_size = queue_size
+        self._channels: dict[str, set] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel: str) -> queue.Queue:
+        subscription = queue.Queue(self.queue_size)
+        with self._lock:
+            self._channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, channel: str, subscription: queue.Queue):
+        with self._lock:
+            self._channels.get(channel, set()).discard(subscription)
+
+    def subscribers(self, channel: str) -> int:
+        with self._lock:
+            return len(self._channels.get(channel, ()))
+
+    def publish(self, channel: str, event: str, data):
+        """Отправить событие в формате Server-Sent Events"""
+        with self._lock:
+            subscriptions = list(self._channels.get(channel, ()))
+        if len(subscriptions) == 0:
+            return
+        message = f"event: {event}\ndata: {json_dumps(data).decode()}\n\n"
+        for subscription in subscriptions:
+            try:
+                subscription.put_nowait(message)
+            except queue.Full:
+                # Медленный клиент теряет самые старые события
+                try:
+                    subscription.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    subscription.put_nowait(message)
+                except queue.Full:
+                    # Очередь успел заполнить другой издатель
+                    pass
+
+
+class CommandDispatcher:
+    """Одновременная отправка команд на несколько ИУ"""
+
+    def __init__(self, workers: int = EXECUTOR_WORKERS) -> None:
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="executor")
+
+    def run(self, commands: list):
+        """Выполнить команды параллельно и дождаться всех ответов"""
+        futures = [self._pool.submit(command) for command in commands]
+        return [future.result() for future in futures]
+
+
+class ReportCache:
+    """LRU-кэш отчётов, действительных для заданной версии данных.
+    Одновременные запросы одного отчёта ждут одного вычисления"""
+
+    def __init__(self, size: int = REPORT_CACHE_SIZE, ttl: float = REPORT_CACHE_TTL) -> None:
+        self.size = size
+        self.ttl = ttl  # [s]
+        self._reports = collections.OrderedDict()
+        self._computing: dict[tuple, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key, version):
+        entry = self._reports.get(key)
+        if entry is None:
+            return None
+        entry_version, moment, report = entry
+        # Окно отчёта сдвигается и без новых данных, поэтому запись стареет
+        if entry_version != version or time.monotonic() - moment > self.ttl:
+            return None
+        self._reports.move_to_end(key)
+        return entry
+
+    def get(self, key: tuple, version: int, compute):
+        """Получить отчёт из кэша или вычислить его"""
+        with self._lock:
+            entry = self._lookup(key, version)
+            if entry is not None:
+                return entry[2]
+            key_lock = self._computing.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                entry = self._lookup(key, version)
+                if entry is not None:
+                    return entry[2]
+            report = compute()
+            with self._lock:
+                self._reports[key] = (version, time.monotonic(), report)
+                self._reports.move_to_end(key)
+                while len(self._reports) > self.size:
+                    evicted, _ = self._reports.popitem(last=False)
+                    self._computing.pop(evicted, None)
+        return report
 
 
 class HeaterDevice(Executor):
@@ -437,6 +1393,7 @@ class HeaterDevice(Executor):
         res = self.send_command({"heating_power": heating_power})
         self.log_event(
             {"command": {"heating_power": heating_power}, "answer": res})
+        self._notify()
 
 
 class ACDevice(Executor):
@@ -450,6 +1407,7 @@ class ACDevice(Executor):
         res = self.send_command({"set_temperature": temperature})
         self.log_event(
             {"command": {"set_temperature": temperature}, "answer": res})
+        self._notify()
 
 
 class VentDevice(Executor):
@@ -462,6 +1420,7 @@ class VentDevice(Executor):
         self.settings = speed
         res = self.send_command({"set_speed": speed})
         self.log_event({"command": {"set_speed": speed}, "answer": res})
+        self._notify()
 
 
 class Humidifier(Executor):
@@ -474,6 +1433,7 @@ class Humidifier(Executor):
         self.settings = volume
         res = self.send_command({"set_volume": volume})
         self.log_event({"command": {"set_volume": volume}, "answer": res})
+        self._notify()
 
 
 class Room:
@@ -493,20 +1453,161 @@ class Room:
     report = {}
     report_period = datetime.timedelta(minutes=env.PERIOD_REPORT)
     forecast_period = datetime.timedelta(minutes=env.PERIOD_FORECAST)
+    # Настройки, общие для всех процессов при SHARED_STATE
+    STATE_FIELDS = ["autocontrol_heater", "autocontrol_ac", "autocontrol_vent",
+                    "autocontrol_humidifier", "temperature_requirement_inf",
+                    "temperature_requirement_sup", "humidity_requirement_inf",
+                    "humidity_requirement_sup", "co2_requirement_acceptable",
+                    "co2_requirement_harmful", "co2_requirement_danger",
+                    "report_period", "forecast_period"]
+    # Датчики, без которых отчёт не составляется
+    REPORT_SENSORS = ["temperature", "humidity", "co2",
+                      "temperature_outer", "humidity_outer"]
+    shared_state = False
+    state_version = 0
+    _state_checked = 0.0
 
     FuzzyAssessment: TypeAlias = Literal['tooLow', 'optimum', 'tooHigh']
     DangerAssessment: TypeAlias = Literal['optimum', 'acceptable',
                                           'harmful', 'danger']
 
-    def __init__(self, name: str, db):
+    def __init__(self, name: str, db, dispatcher: CommandDispatcher = None):
         self.name = name
         self.db: DatabaseLink = db
+        self.sensors: dict[str, Sensor] = {}
+        # Помещения реестра отправляют команды через общий пул потоков
+        self.dispatcher = dispatcher or CommandDispatcher()
+        self.reports = ReportCache()
+        self.data_version = 0
+        self._version_lock = threading.Lock()
         print(f"Created new room named {name}")
 
+    def touch(self, *args):
+        """Отметить изменение данных или настроек помещения"""
+        with self._version_lock:
+            self.data_version += 1
+
+    def get_report(self, period: datetime.timedelta = None):
+        """Получить отчёт из кэша, пересчитывая его только после изменений"""
+        key = (period.total_seconds() if period else None,
+               self.forecast_period.total_seconds())
+        if period is None:
+            return self.reports.get(key, self.data_version, self.make_report)
+        return self.reports.get(key, self.data_version,
+                                lambda: self.make_report(period))
+
+    def share_state(self) -> bool:
+        """Хранить настройки помещения и состояние ИУ в БД.
+        Если состояние уже сохранено другим процессом, применяется оно.
+        Возвращает True, если состояние создано этим процессом"""
+        state = self.dump_state({name: getattr(self, name)
+                                 for name in self.STATE_FIELDS})
+        state["executors"] = {kind: self.dump_executor(executor)
+                              for kind, executor in self.get_executors().items()}
+        record, created = self.db.init_state(self.name, state)
+        self.apply_state(record)
+        self.shared_state = True
+        for executor in self.get_executors().values():
+            executor.add_listener(self.save_executor)
+        return created
+
+    def dump_state(self, values: dict) -> dict:
+        """Привести настройки к виду для хранения в БД"""
+        return {name: value.total_seconds() if isinstance(value, datetime.timedelta)
+                else value for name, value in values.items()}
+
+    def dump_executor(self, executor: Executor) -> dict:
+        return {"power": executor._power_status, "settings": executor.settings,
+                "address": executor.address, "token": executor.token}
+
+    def apply_state(self, record: dict):
+        """Применить общее состояние, прочитанное из БД"""
+        if record["version"] < self.state_version:
+            return
+        for name in self.STATE_FIELDS:
+            if name not in record:
+                continue
+            value = record[name]
+            if name.endswith("_period"):
+                value = datetime.timedelta(seconds=value)
+            setattr(self, name, value)
+        executors = self.get_executors()
+        for kind, state in record.get("executors", {}).items():
+            if kind not in executors:
+                continue
+            # Команды уже отправлены процессом, изменившим состояние
+            executors[kind]._power_status = state["power"]
+            executors[kind].settings = state["settings"]
+            executors[kind].address = state["address"]
+            executors[kind].token = state["token"]
+        self.state_version = record["version"]
+        self.touch()
+
+    def update_state(self, values: dict):
+        """Изменить настройки помещения во всех процессах"""
+        if self.shared_state:
+            self.apply_state(self.db.update_state(
+                self.name, self.dump_state(values)))
+            return
+        for name, value in values.items():
+            setattr(self, name, value)
+        self.touch()
+
+    def save_executor(self, executor: Executor):
+        """Сохранить состояние ИУ после команды"""
+        for kind, device in self.get_executors().items():
+            if device is executor:
+                self.apply_state(self.db.update_state(
+                    self.name, {f"executors.{kind}": self.dump_executor(executor)}))
+
+    def sync_state(self):
+        """Подтянуть изменения, сделанные другими процессами.
+        Версия в БД проверяется не чаще STATE_SYNC_INTERVAL"""
+        if not self.shared_state:
+            return
+        now = time.monotonic()
+        if now - self._state_checked < STATE_SYNC_INTERVAL:
+            return
+        self._state_checked = now
+        if self.db.get_state_version(self.name) > self.state_version:
+            self.apply_state(self.db.get_state(self.name))
+
+    def get_modified(self, fields: list[str] = None) -> float:
+        """Время последней записи измерений по полям (по умолчанию всем датчикам).
+        None, если его нельзя узнать без обращения к БД"""
+        if not SENSOR_BUFFER_AUTHORITATIVE:
+            # Измерения других процессов этот процесс не видит
+            return None
+        sensors = self.get_sensors()
+        if fields is None:
+            fields = list(sensors)
+        if any(x not in sensors for x in fields):
+            return None
+        return max(sensors[x].modified for x in fields)
+
+    def get_sensors(self) -> dict[str, Sensor]:
+        """Датчики помещения по типу измерения"""
+        return dict(self.sensors)
+
+    def get_executors(self) -> dict[str, Executor]:
+        """Исполнительные устройства помещения по назначению"""
+        return {"ac": self.ac_device, "vent": self.vent_device,
+                "heater": self.heater_device, "humidifier": self.humidifier_device}
+
+    def get_scope(self, table: str) -> dict:
+        """Фильтр записей коллекции, относящихся к помещению"""
+        sensors = self.get_sensors()
+        if table in sensors:
+            return sensors[table].scope
+        if table == "device":
+            return {"name": {"$in": [x.name for x in sensors.values()]}}
+        if table == "log":
+            return {"executor": {"$in": [x.name for x in self.get_executors().values()]}}
+        return {}
+
     def make_token_list(self):
-        records = self.db.get("device")
-        pragma = {"temperature": self.temperature_sensor,
-                  "humidity": self.humidity_sensor, "co2": self.co2_sensor, "temperature_outer": self.temperature_sensor_outer, "humidity_outer": self.humidity_sensor_outer}
+        records = self.db.get("device", self.get_scope("device"))
+        pragma = self.get_sensors()
         self._tokens = {record["token"]: pragma[record["pragma"]]
                         for record in records}
 
@@ -524,44 +1625,185 @@ class Room:
         sensor.save(data)
         return 201
 
+    def processing_batch(self, readings: list[dict], token=None) -> list[int]:
+        """Обработать пакет измерений, в том числе от нескольких датчиков.
+        Возвращает код результата для каждого измерения"""
+        codes = [None] * len(readings)
+        batches: dict[Sensor, list] = {}
+        latest = datetime.datetime.now() + datetime.timedelta(seconds=MAX_CLOCK_SKEW)
+        for index, reading in enumerate(readings):
+            if not isinstance(reading, dict):
+                codes[index] = 400
+                continue
+            reading_token = reading.get("Auth", token)
+            if reading_token == ("" or None):
+                codes[index] = 403
+                continue
+            if not self.is_in_tokens_list(reading_token):
+                codes[index] = 401
+                continue
+            data = reading.get("value")
+            # Пакет проверяется целиком до записи первого измерения
+            if data == ("" or None) or not self._tokens[reading_token].validate(data):
+                codes[index] = 400
+                continue
+            try:
+                date = parse_device_date(reading.get("date"))
+            except (TypeError, ValueError, OverflowError, OSError):
+                codes[index] = 400
+                continue
+            if date is not None and date > latest:
+                codes[index] = 400
+                continue
+            batches.setdefault(self._tokens[reading_token], []).append(
+                (index, data, date))
+        for sensor, batch in batches.items():
+            indexes, data, dates = zip(*batch)
+            accepted = sensor.save_many(list(data), list(dates))
+            for index, ok in zip(indexes, accepted):
+                codes[index] = 201 if ok else 400
+        return codes
+
     def get_history(self, period: datetime.timedelta =
-                    datetime.timedelta(hours=6)):
+                    datetime.timedelta(hours=6), fields: list[str] = None,
+                    points: int = None, method: str = "lttb", since: float = None):
+        """Получить историю за период.
+        Если задано points, ряды измерений прореживаются на сервере,
+        если задано since [s эпохи], отдаются только более новые записи"""
         history = {}
-        collections = ["temperature", "humidity", "temperature_outer",
-                       "humidity_outer", "co2", "device", "log"]
+        sensors = self.get_sensors()
+        collections = list(sensors) + ["device", "log"]
+        if fields is not None:
+            collections = [x for x in collections if x in fields]
+        end = datetime.datetime.now()
+        begin = end - period
+        if DB_LAYOUT == "unified" and points is None:
+            # Сырые ряды всех датчиков читаются одним запросом к общей коллекции
+            history |= self.get_unified_history(
+                [x for x in collections if x in sensors], begin, end)
         for table in collections:
-            records = self.db.get_for_period(table,
-                                             datetime.datetime.now() - period,
-                                             datetime.datetime.now())
-            records = [{x: d[x] for x in d if x != '_id'} for d in records]
+            if table in history:
+                continue
+            if points is not None and table in sensors:
+                history |= {table: self.get_downsampled(
+                    sensors[table], period, points, method, since)}
+                continue
+            records = self.db.get_for_period(table, begin, end,
+                                             projection={"_id": 0},
+                                             match=self.get_scope(table))
             history |= {table: records}
+        if since is not None:
+            history = {table: [x for x in records if x["date"].timestamp() > since]
+                       for table, records in history.items()}
+        return history
+
+    def get_unified_history(self, tables: list[str], begin: datetime.datetime,
+                            end: datetime.datetime) -> dict[str, list]:
+        """Получить сырые ряды нескольких датчиков из общей коллекции
+        в прежнем виде {"date", "sensor", <измерение>}"""
+        sensors = self.get_sensors()
+        history = {table: [] for table in tables}
+        if not tables:
+            return history
+        # Записи из архива не хранят тип измерения
+        names = {sensors[x].name: x for x in tables}
+        match = {"kind": {"$in": tables}, "sensor": {"$in": list(names)}}
+        for record in self.db.iter_for_period(MEASUREMENT_COLLECTION, begin, end,
+                                              {"_id": 0}, EXPORT_BATCH_SIZE, match):
+            table = names[record["sensor"]]
+            history[table].append({"date": record["date"],
+                                   "sensor": record["sensor"],
+                                   table: record["value"]})
         return history
 
+    def export_history(self, period: datetime.timedelta, fields: list[str] = None,
+                       fmt: str = "ndjson", batch_size: int = EXPORT_BATCH_SIZE):
+        """Построчно выгрузить историю в NDJSON или CSV.
+        Записи читаются из курсора БД и не накапливаются в памяти"""
+        end = datetime.datetime.now()
+        begin = end - period
+        sensors = self.get_sensors()
+        collections = list(sensors) + ["device", "log"]
+        if fields is not None:
+            collections = [x for x in collections if x in fields]
+        if fmt == "csv":
+            # В CSV выгружаются только измерения: у них общий набор полей
+            collections = [x for x in collections if x in sensors]
+            line = io.StringIO()
+            writer = csv.writer(line)
+            writer.writerow(["collection", "sensor", "date", "value"])
+            yield line.getvalue()
+        for table in collections:
+            sensor = sensors.get(table)
+            collection = table if sensor is None else sensor.collection
+            for record in self.db.iter_for_period(collection, begin, end,
+                                                  {"_id": 0}, batch_size,
+                                                  self.get_scope(table)):
+                if sensor is not None and DB_LAYOUT == "unified":
+                    record = {"date": record["date"], "sensor": record["sensor"],
+                              table: record["value"]}
+                if fmt == "csv":
+                    line.seek(0)
+                    line.truncate()
+                    writer.writerow([table, record.get("sensor"),
+                                     record["date"].isoformat(),
+                                     record.get(table)])
+                    yield line.getvalue()
+                else:
+                    yield json_dumps({"collection": table} | record).decode() + "\n"
+
+    def get_columns(self, sensor: Sensor, period: datetime.timedelta,
+                    points: int = None, method: str = "lttb", since: float = None) -> dict[str, tuple]:
+        """Получить ряды датчика в виде массивов (время, значения),
+        при необходимости прореженные до points точек"""
+        field = sensor.pragma
+        dates, values = sensor.get_for_period(period)
+        if since is not None:
+            newer = dates > since
+            dates, values = dates[newer], values[newer]
+        if points is None:
+            return {field: (dates, values)}
+        if method == "minmax":
+            dates, minimum, average, maximum = downsample_buckets(
+                dates, values, points)
+            return {field: (dates, average),
+                    f"{field}_min": (dates, minimum),
+                    f"{field}_max": (dates, maximum)}
+        selected = downsample_lttb(dates, values, points)
+        return {field: (dates[selected], values[selected])}
+
+    def get_downsampled(self, sensor: Sensor, period: datetime.timedelta,
+                        points: int, method: str = "lttb", since: float = None):
+        """Получить ряд измерений датчика, прореженный до points точек"""
+        columns = self.get_columns(sensor, period, points, method, since)
+        dates = columns[sensor.pragma][0].tolist()
+        series = {name: values.tolist()
+                  for name, (_, values) in columns.items()}
+        return [{"date": datetime.datetime.fromtimestamp(date)} |
+                {name: values[i] for name, values in series.items()}
+                for i, date in enumerate(dates)]
+
+    def get_history_columns(self, period: datetime.timedelta, fields: list[str] = None,
+                            points: int = None, method: str = "lttb", since: float = None) -> bytes:
+        """Получить историю измерений в колоночном бинарном формате"""
+        columns = {}
+        for field, sensor in self.get_sensors().items():
+            if fields is None or field in fields:
+                columns |= self.get_columns(sensor, period, points, method, since)
+        return pack_columns(columns)
+
     def set_report_period(self, period: datetime.timedelta = datetime.timedelta(minutes=5)):
         self.report_period = period
 
     def set_forecast_period(self, period: datetime.timedelta = datetime.timedelta(minutes=5)):
         self.forecast_period = period
 
-    def set_temperature_sensor(self, name, token):
-        sensor = TemperatureSensor(name, token, self.db)
-        self.temperature_sensor = sensor
-
-    def set_humidity_sensor(self, name, token):
-        sensor = HumiditySensor(name, token, self.db)
-        self.humidity_sensor = sensor
-
-    def set_temperature_sensor_outer(self, name, token):
-        sensor = TemperatureSensorOuter(name, token, self.db)
-        self.temperature_sensor_outer = sensor
-
-    def set_humidity_sensor_outer(self, name, token):
-        sensor = HumiditySensorOuter(name, token, self.db)
-        self.humidity_sensor_outer = sensor
-
-    def set_co2_sensor(self, name, token):
-        sensor = CO2Sensor(name, token, self.db)
-        self.co2_sensor = sensor
+    def set_sensor(self, pragma: str, name, token):
+        """Установить датчик типа измерения из SENSOR_KINDS"""
+        sensor = Sensor(name, token, self.db, pragma)
+        sensor.room = self.name
+        sensor.add_listener(self.touch)
+        self.sensors[pragma] = sensor
 
     def set_ac_devices(self, name, address, token):
         device = ACDevice(name, address, token, self.db)
@@ -621,26 +1863,41 @@ class Room:
             assessment = "optimum"
         return assessment
 
+    def get_statistics(self, period: datetime.timedelta) -> dict[str, tuple]:
+        """Среднее, тренд и прогноз каждого датчика за период"""
+        sensors = self.get_sensors()
+        end = datetime.datetime.now()
+        begin = end - period
+        match = {"sensor": {"$in": [x.name for x in sensors.values()]}}
+        if DB_LAYOUT == "unified" and not SENSOR_BUFFER_AUTHORITATIVE and \
+                self.db.choose_rollup(period) is None and \
+                self.db.split_archived(MEASUREMENT_COLLECTION, begin, end, match) is None:
+            # Все каналы помещения лежат в одной коллекции: один запрос на отчёт
+            sums = self.db.get_regression_sums(MEASUREMENT_COLLECTION, "value",
+                                               begin, end, match=match, group="sensor")
+            empty = {"n": 0}
+            return {pragma: statistics_from_sums(sums.get(sensor.name, empty), self.forecast_period)
+                    for pragma, sensor in sensors.items()}
+        return {pragma: sensor.get_statistics(period, self.forecast_period)
+                for pragma, sensor in sensors.items()}
+
     def make_report(self, period: datetime.timedelta = report_period):
         """Составить оценку атмосферных параметров"""
 
-        if not self.temperature_sensor:
-            print("Temperature sensor not set!")
-            return None
-        if not self.humidity_sensor:
-            print("Humidity sensor not set!")
-            return None
-        if not self.co2_sensor:
-            print("CO2 sensor not set!")
-            return None
+        sensors = self.get_sensors()
+        for pragma in self.REPORT_SENSORS:
+            if pragma not in sensors:
+                print(f"Sensor {pragma} not set!")
+                return None
 
-        temperature = self.temperature_sensor.get_average(period)
-        humidity = self.humidity_sensor.get_average(period)
-        co2 = self.co2_sensor.get_average(period)
-        temperature_outer = self.temperature_sensor_outer.get_average(period)
-        humidity_outer = self.humidity_sensor_outer.get_average(period)
+        statistics = self.get_statistics(period)
+        temperature, temperature_trend, temperature_forecast = statistics["temperature"]
+        humidity, humidity_trend, humidity_forecast = statistics["humidity"]
+        co2, co2_trend, co2_forecast = statistics["co2"]
+        temperature_outer = statistics["temperature_outer"][0]
+        humidity_outer = statistics["humidity_outer"][0]
 
-        if not self.temperature_sensor.validate(temperature) or not self.humidity_sensor.validate(humidity) or not self.co2_sensor.validate(co2):
+        if not sensors["temperature"].validate(temperature) or not sensors["humidity"].validate(humidity) or not sensors["co2"].validate(co2):
             return None
 
         temperature_assessment: self.FuzzyAssessment =\
@@ -654,17 +1911,6 @@ class Room:
         humidity_outer_assessment: self.FuzzyAssessment =\
             self.make_humidity_assessment(humidity_outer)
 
-        temperature_trend = self.temperature_sensor.get_trend(period)
-        humidity_trend = self.humidity_sensor.get_trend(period)
-        co2_trend = self.co2_sensor.get_trend(period)
-
-        temperature_forecast = self.temperature_sensor.get_forecast(
-            period, self.forecast_period)
-        humidity_forecast = self.humidity_sensor.get_forecast(
-            period, self.forecast_period)
-        co2_forecast = self.co2_sensor.get_forecast(
-            period, self.forecast_period)
-
         temperature_forecast_assessment =\
             self.make_temperature_assessment(temperature_forecast)
         humidity_forecast_assessment =\
@@ -677,13 +1923,8 @@ class Room:
         heater_power = self.heater_device.get_power_status()
         humidifier_power = self.humidifier_device.get_power_status()
         report = {
-            "value": {
-                "temperature": np.round(temperature, 1),
-                "humidity": np.round(humidity, 0),
-                "co2": np.round(co2, 0),
-                "temperature_outer": np.round(temperature_outer, 1),
-                "humidity_outer": np.round(humidity_outer, 0),
-            },
+            "value": {pragma: sensor.kind.round(statistics[pragma][0])
+                      for pragma, sensor in sensors.items()},
             "assessment": {
                 "temperature": temperature_assessment,
                 "humidity": humidity_assessment,
@@ -723,6 +1964,14 @@ class Room:
 
     def autocontrol(self, report):
         """Использовать ИУ для повышения атмосферных качеств"""
+        commands = self.plan_autocontrol(report)
+        self.dispatcher.run([functools.partial(executor.switch_power, power)
+                             for executor, power in commands])
+        if commands:
+            self.touch()
+
+    def plan_autocontrol(self, report) -> list[tuple[Executor, bool]]:
+        """Выбрать команды включения ИУ (устройство, состояние) по отчёту"""
         temperature_forecast = report["forecast_assessment"]["temperature"]
         humidity_forecast = report["forecast_assessment"]["humidity"]
         temperature_outer = report["assessment"]["temperature_outer"]
@@ -794,19 +2043,420 @@ class Room:
                         else:
                             ac_power = True
 
+        commands = []
         if co2_forecast == "danger" or co2 == "danger":
             vent_power = True
             if not self.autocontrol_vent:
-                self.vent_device.switch_power(vent_power)
+                commands.append((self.vent_device, vent_power))
         if (co2_forecast == "harmful" or co2 == "harmful") and \
                 temperature_forecast == "optimum":
             vent_power = True
 
         if self.autocontrol_vent and vent_power:
-            self.vent_device.switch_power(vent_power)
+            commands.append((self.vent_device, vent_power))
         if self.autocontrol_ac and ac_power:
-            self.ac_device.switch_power(ac_power)
+            commands.append((self.ac_device, ac_power))
         if self.autocontrol_heater and heater_power:
-            self.heater_device.switch_power(heater_power)
+            commands.append((self.heater_device, heater_power))
         if self.autocontrol_humidifier and humidifier_power:
-            self.humidifier_device.switch_power(humidifier_power)
+            commands.append((self.humidifier_device, humidifier_power))
+        return commands
+
+
+class LeaderLease:
+    """Роль ведущего среди процессов с общей БД.
+    Аренда продлевается при проверке, не реже чем раз в треть срока"""
+
+    def __init__(self, db: DatabaseLink, name: str, ttl: float = LEADER_LEASE_TTL) -> None:
+        self.db = db
+        self.name = name
+        self.ttl = ttl  # [s]
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex}"
+        self._held = False
+        self._renewed = 0.0
+
+    def held(self) -> bool:
+        """Является ли процесс ведущим"""
+        now = time.monotonic()
+        if self._held and now - self._renewed < self.ttl / 3:
+            return True
+        try:
+            self._held = self.db.acquire_lease(self.name, self.owner, self.ttl)
+        except pymongo.errors.PyMongoError as error:
+            print(f"Lease {self.name} check failed: {error}")
+            self._held = False
+        self._renewed = now
+        return self._held
+
+
+class ControlLoop:
+    """Фоновый цикл составления отчёта и автоуправления помещениями.
+    По сигналу о новых данных пересчитываются только изменившиеся помещения.
+    Помещения обрабатываются параллельно в пуле потоков, поэтому
+    недоступные ИУ одного помещения не задерживают остальные"""
+
+    def __init__(self, rooms: list[Room], tick: float = CONTROL_TICK, debounce: float = CONTROL_DEBOUNCE,
+                 workers: int = CONTROL_WORKERS, lease: LeaderLease = None) -> None:
+        self.rooms = rooms
+        # Отчёты нужны подписчикам каждого процесса, а команды ИУ
+        # при нескольких процессах отправляет только ведущий
+        self.lease = lease
+        self.tick = tick  # [s]
+        self.debounce = debounce  # [s]
+        self.workers = workers
+        self._pool: concurrent.futures.ThreadPoolExecutor = None
+        self._dirty: dict[str, Room] = {}
+        self._running: set[str] = set()
+        self._dirty_lock = threading.Lock()
+        self._new_data = threading.Event()
+        self._stop = threading.Event()
+        self._listeners = []
+        self._thread = threading.Thread(
+            target=self._run, name="control-loop", daemon=True)
+
+    def add_listener(self, callback):
+        """Подписаться на новые отчёты: callback(room, report)"""
+        self._listeners.append(callback)
+
+    def _notify(self, room: Room, report: dict):
+        for callback in self._listeners:
+            try:
+                callback(room, report)
+            except Exception as error:
+                print(f"Report listener of room {room.name} failed: {error}")
+
+    def start(self):
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="control")
+        self._thread.start()
+        print(f"Control loop started for {len(self.rooms)} rooms")
+
+    def stop(self):
+        self._stop.set()
+        self._new_data.set()
+        self._thread.join()
+        self._pool.shutdown()
+
+    def notify(self, room: Room):
+        """Сообщить о новых данных в помещении"""
+        with self._dirty_lock:
+            self._dirty[room.name] = room
+        self._new_data.set()
+
+    def _run(self):
+        next_tick = time.monotonic() + self.tick
+        while not self._stop.is_set():
+            if self._new_data.wait(max(next_tick - time.monotonic(), 0)):
+                # Даём датчикам блока досылать показания, чтобы
+                # пачка измерений вызвала один пересчёт
+                self._stop.wait(self.debounce)
+            self._new_data.clear()
+            if self._stop.is_set():
+                break
+            with self._dirty_lock:
+                rooms = list(self._dirty.values())
+                self._dirty.clear()
+            if time.monotonic() >= next_tick:
+                rooms = self.rooms
+                next_tick = time.monotonic() + self.tick
+            for room in rooms:
+                self.submit(room)
+
+    def submit(self, room: Room):
+        """Запустить цикл помещения в пуле, если он ещё не выполняется"""
+        with self._dirty_lock:
+            if room.name in self._running:
+                # Помещение пересчитается сразу после текущего цикла
+                self._dirty[room.name] = room
+                return
+            self._running.add(room.name)
+        self._pool.submit(self._cycle, room)
+
+    def _cycle(self, room: Room):
+        try:
+            self.cycle(room)
+        finally:
+            with self._dirty_lock:
+                self._running.discard(room.name)
+                if room.name in self._dirty:
+                    self._new_data.set()
+
+    def cycle(self, room: Room):
+        """Составить отчёт и применить автоуправление"""
+        try:
+            room.sync_state()
+            report = room.get_report()
+            if report is None:
+                return
+            self._notify(room, report)
+            if self.lease is None or self.lease.held():
+                room.autocontrol(report)
+        except Exception as error:
+            print(f"Control cycle of room {room.name} failed: {error}")
+
+
+class TokenIndex:
+    """Общий индекс токенов датчиков всех помещений.
+    Поиск идёт в памяти процесса, изменения применяются по одному и
+    доходят до других процессов через номера изменений в БД"""
+
+    def __init__(self, db: DatabaseLink, interval: float = TOKEN_SYNC_INTERVAL) -> None:
+        self.db = db
+        self.interval = interval  # [s]
+        self.seq = 0
+        self._tokens: dict[str, tuple[Room, Sensor]] = {}
+        self._sensors: dict[str, tuple[Room, Sensor]] = {}
+        self._names: dict[str, set] = {}
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._watch, name="token-index", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def add(self, room: Room):
+        """Добавить датчики помещения в индекс"""
+        room.make_token_list()
+        with self._lock:
+            for sensor in room.get_sensors().values():
+                self._sensors[sensor.name] = (room, sensor)
+            for token, sensor in room._tokens.items():
+                self._tokens[token] = (room, sensor)
+                self._names.setdefault(sensor.name, set()).add(token)
+
+    def get(self, token) -> tuple[Room, Sensor]:
+        return self._tokens.get(token)
+
+    def apply(self, name: str, token):
+        """Применить изменение токена одного датчика"""
+        with self._lock:
+            route = self._sensors.get(name)
+            if route is None:
+                # Датчик обслуживается другим процессом
+                return
+            room, sensor = route
+            for old in self._names.pop(name, set()):
+                self._tokens.pop(old, None)
+                room._tokens.pop(old, None)
+            sensor._token = token
+            if token not in (None, ""):
+                self._tokens[token] = route
+                room._tokens[token] = sensor
+                self._names[name] = {token}
+
+    def sync(self):
+        """Применить изменения токенов, сделанные этим и другими процессами"""
+        with self._sync_lock:
+            # Номер выдаётся до записи, поэтому изменение с меньшим номером
+            # может появиться позже; последние изменения применяются повторно
+            for record in self.db.get_token_changes(self.seq - TOKEN_SYNC_LOOKBACK):
+                self.apply(record["name"], record.get("token"))
+                self.seq = max(self.seq, record["seq"])
+
+    def _watch(self):
+        try:
+            with self.db.watch_tokens(self.interval) as stream:
+                print("Token index follows the device change stream")
+                while not self._stop.is_set():
+                    if stream.try_next() is not None:
+                        self.sync()
+            return
+        except Exception as error:
+            # Отдельный сервер MongoDB не поддерживает потоки изменений
+            print(f"Change streams are unavailable ({error}), token index polls the database")
+        while not self._stop.wait(self.interval):
+            try:
+                self.sync()
+            except pymongo.errors.PyMongoError as error:
+                print(f"Token index sync failed: {error}")
+
+
+class Archiver:
+    """Фоновый перенос завершённых суток измерений в архив.
+    Выполняется при запуске и затем раз в ARCHIVE_INTERVAL"""
+
+    def __init__(self, db: DatabaseLink, rooms: list[Room], interval: float = ARCHIVE_INTERVAL,
+                 lease: LeaderLease = None) -> None:
+        self.db = db
+        self.rooms = rooms
+        # TTL включается, когда архив догнал БД, иначе удалится неархивированное
+        self.retention = False
+        self.interval = interval  # [s]
+        # При нескольких процессах архив пишет только ведущий
+        self.lease = lease
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="archiver", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            self.run_once()
+            if self._stop.wait(self.interval):
+                break
+
+    def run_once(self):
+        complete = True
+        for room in self.rooms:
+            for sensor in room.get_sensors().values():
+                if self.lease is not None and not self.lease.held():
+                    return
+                try:
+                    sensor.archive()
+                except Exception as error:
+                    complete = False
+                    print(f"Archiving of {sensor.name} failed: {error}")
+        if complete and not self.retention:
+            self.db.ensure_retention(measurement_collections())
+            self.retention = True
+
+
+class RoomRegistry:
+    """Реестр помещений с общим индексом токенов датчиков"""
+
+    def __init__(self, db: DatabaseLink) -> None:
+        self.db = db
+        self.rooms: dict[str, Room] = {}
+        self.dispatcher = CommandDispatcher()
+        self.tokens = TokenIndex(db)
+        self.hub = Broadcaster()
+        leases = {"control": None, "archive": None}
+        if SHARED_STATE:
+            leases = {name: LeaderLease(db, name) for name in leases}
+        self.control_loop = ControlLoop([], lease=leases["control"])
+        self.control_loop.add_listener(self.publish_report)
+        self.archiver = Archiver(db, [], lease=leases["archive"])
+
+    def build(self, config: list[dict]):
+        """Создать помещения по конфигурации"""
+        for room_config in config:
+            self.add(self.make_room(room_config))
+
+    def make_room(self, config: dict) -> Room:
+        """Создать помещение с датчиками и ИУ по описанию"""
+        room = Room(config["name"], self.db, self.dispatcher)
+        executor_setters = {"ac": room.set_ac_devices,
+                            "heater": room.set_heater_device,
+                            "vent": room.set_vent_device,
+                            "humidifier": room.set_humidifier_device}
+        settings_setters = {"ac": room.set_ac_temperature,
+                            "heater": room.set_heater_power,
+                            "vent": room.set_vent_speed,
+                            "humidifier": room.set_humidifier_volume}
+        for kind, sensor in config["sensors"].items():
+            room.set_sensor(kind, sensor["name"], sensor["token"])
+        for kind, executor in config["executors"].items():
+            executor_setters[kind](executor["name"], executor["address"],
+                                   executor["token"])
+        for kind, value in config.get("autocontrol", {}).items():
+            setattr(room, f"autocontrol_{kind}", value)
+        settings = config.get("settings", {})
+        if SHARED_STATE:
+            # Настройки конфигурации входят в создаваемое общее состояние.
+            # Если его уже создал другой процесс, ИУ работают по нему
+            # и команды не отправляются
+            executors = room.get_executors()
+            for kind, value in settings.items():
+                executors[kind].settings = value
+            if not room.share_state():
+                settings = {}
+        room.dispatcher.run([functools.partial(settings_setters[kind], value)
+                             for kind, value in settings.items()])
+        return room
+
+    def add(self, room: Room):
+        """Добавить помещение в реестр"""
+        if room.name in self.rooms:
+            raise ValueError(f"Room {room.name} already exists")
+        names = {x.name for x in room.get_sensors().values()}
+        for other in self.rooms.values():
+            # Измерения хранятся в общих коллекциях по имени датчика
+            if names & {x.name for x in other.get_sensors().values()}:
+                raise ValueError(
+                    f"Sensor names of room {room.name} clash with room {other.name}")
+        self.rooms[room.name] = room
+        self.control_loop.rooms.append(room)
+        self.archiver.rooms.append(room)
+        self.tokens.add(room)
+        for sensor in room.get_sensors().values():
+            sensor.add_listener(functools.partial(self.publish_samples, room))
+
+    def publish_report(self, room: Room, report: dict):
+        self.hub.publish(room.name, "report", report)
+
+    def publish_samples(self, room: Room, sensor: Sensor, records: list[dict]):
+        """Разослать новые измерения датчика (время в мс эпохи)"""
+        if self.hub.subscribers(room.name) == 0:
+            return
+        self.hub.publish(room.name, "sample", {
+            "field": sensor.pragma,
+            "dates": [x["date"].timestamp() * 1000 for x in records],
+            "values": [float(x[sensor.field]) for x in records]})
+
+    def get(self, name: str = None) -> Room:
+        """Получить помещение по имени (по умолчанию первое)"""
+        if name is None:
+            return next(iter(self.rooms.values()))
+        return self.rooms.get(name)
+
+    def refresh_tokens(self):
+        """Применить изменения токенов, не дожидаясь фоновой синхронизации"""
+        self.tokens.sync()
+
+    def route(self, token) -> tuple[Room, Sensor]:
+        """Найти помещение и датчик по токену"""
+        if token == ("" or None):
+            return None
+        return self.tokens.get(token)
+
+    def processing_request(self, token, data):
+        if token == ("" or None):
+            return 403
+        route = self.route(token)
+        if route is None:
+            return 401
+        room, _ = route
+        code = room.processing_request(token, data)
+        if code == 201:
+            self.control_loop.notify(room)
+        return code
+
+    def processing_batch(self, readings: list[dict], token=None) -> list[int]:
+        """Разнести пакет измерений по помещениям"""
+        codes = [None] * len(readings)
+        batches: dict[str, list] = {}
+        for index, reading in enumerate(readings):
+            if not isinstance(reading, dict):
+                codes[index] = 400
+                continue
+            reading_token = reading.get("Auth", token)
+            if reading_token == ("" or None):
+                codes[index] = 403
+                continue
+            route = self.route(reading_token)
+            if route is None:
+                codes[index] = 401
+                continue
+            batches.setdefault(route[0].name, []).append(
+                (index, reading | {"Auth": reading_token}))
+        for name, batch in batches.items():
+            room = self.rooms[name]
+            indexes, room_readings = zip(*batch)
+            room_codes = room.processing_batch(list(room_readings))
+            for index, code in zip(indexes, room_codes):
+                codes[index] = code
+            if 201 in room_codes:
+                self.control_loop.notify(room)
+        return codes
@@ -1,61 +1,180 @@
-from flask import Flask, render_template, request, Response
+from flask import Flask, render_template, request, Response, stream_with_context, abort, make_response
+from flask.json.provider import DefaultJSONProvider
 from classes import *
+from udp_listener import UDPListener, UDP_PORT
 import datetime
+import functools
+import gzip
+import queue
+import time
 import env
 
+try:
+    # Необязательная зависимость: сжатие ответов brotli
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = getattr(env, "COMPRESS_MIN_SIZE", 1024)  # [B]
+COMPRESS_LEVEL = getattr(env, "COMPRESS_LEVEL", 5)
+
 # Prepare
 
 db = DatabaseLink(database=env.DB_DATABASE, host=env.DB_HOST,
                   username=env.DB_USERNAME, password=env.DB_PASSWORD)
 
-# Make room "Main"
-room = Room("main", db)
-
-room.set_temperature_sensor("temperature",
-                            env.SENSOR_TEMPERATURE_TOKEN)
-room.set_humidity_sensor("humidity",
-                         env.SENSOR_HUMIDITY_TOKEN)
-room.set_temperature_sensor_outer("temperature_outer",
-                                  env.SENSOR_TEMPERATURE_OUTER_TOKEN)
-room.set_humidity_sensor_outer("humidity_outer",
-                               env.SENSOR_HUMIDITY_OUTER_TOKEN)
-room.set_co2_sensor("carbondioxide",
-                    env.SENSOR_CO2_TOKEN)
-
-room.set_ac_devices("battery_relay",
-                    env.EXECUTOR_AC_ADDRESS,
-                    env.EXECUTOR_AC_TOKEN)
-room.set_heater_device("conditioner",
-                       env.EXECUTOR_HEATER_ADDRESS,
-                       env.EXECUTOR_HEATER_TOKEN)
-room.set_vent_device("window_opener",
-                     env.EXECUTOR_VENT_ADDRESS,
-                     env.EXECUTOR_VENT_TOKEN)
-room.set_humidifier_device("GARLYN_AirWash_V30",
-                           env.EXECUTOR_HUMIDIFIER_ADDRESS,
-                           env.EXECUTOR_HUMIDIFIER_TOKEN)
-
-room.set_heater_power(400)      # [W]
-room.set_ac_temperature(16)     # [degC]
-room.set_vent_speed(100)        # [%]
-room.set_humidifier_volume(80)  # [%]
-
-room.make_token_list()
-room.autocontrol_vent = True
-room.autocontrol_ac = True
-room.autocontrol_heater = True
-room.autocontrol_humidifier = True
+# Помещение "main" по умолчанию; несколько помещений задаются в env.ROOMS
+ROOMS = getattr(env, "ROOMS", None) or [{
+    "name": "main",
+    "sensors": {
+        "temperature": {"name": "temperature",
+                        "token": env.SENSOR_TEMPERATURE_TOKEN},
+        "humidity": {"name": "humidity",
+                     "token": env.SENSOR_HUMIDITY_TOKEN},
+        "temperature_outer": {"name": "temperature_outer",
+                              "token": env.SENSOR_TEMPERATURE_OUTER_TOKEN},
+        "humidity_outer": {"name": "humidity_outer",
+                           "token": env.SENSOR_HUMIDITY_OUTER_TOKEN},
+        "co2": {"name": "carbondioxide",
+                "token": env.SENSOR_CO2_TOKEN},
+    },
+    "executors": {
+        "ac": {"name": "battery_relay",
+               "address": env.EXECUTOR_AC_ADDRESS,
+               "token": env.EXECUTOR_AC_TOKEN},
+        "heater": {"name": "conditioner",
+                   "address": env.EXECUTOR_HEATER_ADDRESS,
+                   "token": env.EXECUTOR_HEATER_TOKEN},
+        "vent": {"name": "window_opener",
+                 "address": env.EXECUTOR_VENT_ADDRESS,
+                 "token": env.EXECUTOR_VENT_TOKEN},
+        "humidifier": {"name": "GARLYN_AirWash_V30",
+                       "address": env.EXECUTOR_HUMIDIFIER_ADDRESS,
+                       "token": env.EXECUTOR_HUMIDIFIER_TOKEN},
+    },
+    "settings": {
+        "heater": 400,      # [W]
+        "ac": 16,           # [degC]
+        "vent": 100,        # [%]
+        "humidifier": 80,   # [%]
+    },
+    "autocontrol": {"vent": True, "ac": True,
+                    "heater": True, "humidifier": True},
+}]
+
+registry = RoomRegistry(db)
+registry.build(ROOMS)
+
+# Отчёт и автоуправление выполняются в фоне, а не в запросе датчика
+registry.control_loop.start()
+# Изменения токенов из других процессов применяются в фоне
+registry.tokens.start()
+# Завершённые сутки переносятся в архив до удаления из БД по TTL
+if db.archive is not None:
+    registry.archiver.start()
+# Приём измерений по UDP включается параметром env.UDP_PORT
+udp_listener = None
+if UDP_PORT is not None:
+    udp_listener = UDPListener(registry)
+    udp_listener.start()
 
 # Flask functions
 
+class FastJSONProvider(DefaultJSONProvider):
+    """JSON-ответы через json_dumps: время в ISO 8601, поддержка NumPy"""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return json_dumps(obj).decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(json_dumps(obj), mimetype=self.mimetype)
+
+
 app = Flask(__name__, static_folder="static")
+app.json = FastJSONProvider(app)
+
+
+def compress(data: bytes, accepted) -> tuple[bytes, str]:
+    """Сжать тело ответа (brotli или gzip по Accept-Encoding).
+    Кодировка None - тело не сжато"""
+    if len(data) < COMPRESS_MIN_SIZE:
+        return data, None
+    if brotli is not None and accepted["br"]:
+        return brotli.compress(data, quality=COMPRESS_LEVEL), "br"
+    if accepted["gzip"]:
+        return gzip.compress(data, compresslevel=COMPRESS_LEVEL), "gzip"
+    return data, None
+
+
+def set_compressed(response, data: bytes, encoding: str):
+    """Заменить тело ответа сжатым (общее для Flask и Quart)"""
+    response.set_data(data)
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    etag, _ = response.get_etag()
+    if etag:
+        # Сжатое представление отличается побайтно
+        response.set_etag(etag, weak=True)
+
+
+@app.after_request
+def compress_response(response):
+    """Сжать ответ /api/get/* (brotli или gzip по Accept-Encoding)"""
+    if not request.path.startswith("/api/get/") or response.status_code != 200 \
+            or response.is_streamed or "Content-Encoding" in response.headers:
+        return response
+    data, encoding = compress(response.get_data(), request.accept_encodings)
+    if encoding is not None:
+        set_compressed(response, data, encoding)
+    return response
 
 # Errors
 
 
 @app.errorhandler(404)
 def page_not_found(error):
-    return render_template("error.html", error=404, comment="Ложки не существует")
+    if request.path.startswith("/api/"):
+        return {"error": 404}, 404
+    return render_template("error.html", error=404, comment="Ложки не существует"), 404
+
+
+def get_room() -> Room:
+    """Помещение из параметра ?room= (по умолчанию первое)"""
+    room = registry.get(request.args.get("room"))
+    if room is None:
+        abort(404)
+    room.sync_state()
+    return room
+
+
+def get_since(period: datetime.timedelta) -> tuple[float, datetime.timedelta]:
+    """Параметр ?since= [s эпохи] и сокращённый по нему период"""
+    since = request.args.get("since", type=float)
+    if since is not None:
+        period = min(period, datetime.timedelta(
+            seconds=max(datetime.datetime.now().timestamp() - since, 0)))
+    return since, period
+
+
+def not_modified(etag: str, modified: float) -> bool:
+    """Данные у клиента актуальны (If-None-Match / If-Modified-Since)"""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since is not None:
+        # Last-Modified точен до секунды: измерение, пришедшее в ту же секунду
+        # после ответа, не отличить, поэтому эта секунда считается изменённой
+        return modified < request.if_modified_since.timestamp()
+    return False
+
+
+def conditional(response, etag: str, modified: float):
+    """Добавить к ответу валидаторы ETag и Last-Modified"""
+    response = make_response(response)
+    response.set_etag(etag)
+    response.last_modified = datetime.datetime.fromtimestamp(
+        modified, datetime.timezone.utc)
+    return response
 
 # API
 
@@ -64,38 +183,68 @@ def page_not_found(error):
 def api_device_send():
     token = request.json["Auth"]
     value = request.json["value"]
-    code = room.processing_request(token, value)
-    report = room.make_report()
-    room.autocontrol(report)
+    code = registry.processing_request(token, value)
     return Response(status=code)
 
 
+@app.route("/api/device/send_batch", methods=["POST"])
+def api_device_send_batch():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return Response(status=400)
+    readings = body.get("readings")
+    if not isinstance(readings, list) or len(readings) == 0:
+        return Response(status=400)
+    codes = registry.processing_batch(readings, body.get("Auth"))
+    stored = codes.count(201)
+    if stored == len(codes):
+        status = 201
+    elif stored:
+        status = 207
+    else:
+        status = codes[0]
+    return {"stored": stored, "status": codes}, status
+
+
 @app.route("/api/device/settings", methods=["POST"])
 def api_device_settings():
+    room = get_room()
     settings: dict[dict] = request.json
     if ("executor_on" in settings and len(settings["executor_on"])):
+        commands = []
         for exe, val in settings["executor_on"].items():
             match exe:
                 case "ac":
-                    room.ac_device.switch_power(val)
+                    commands.append(functools.partial(
+                        room.ac_device.switch_power, val))
                 case "vent":
-                    room.vent_device.switch_power(val)
+                    commands.append(functools.partial(
+                        room.vent_device.switch_power, val))
                 case "heater":
-                    room.heater_device.switch_power(val)
+                    commands.append(functools.partial(
+                        room.heater_device.switch_power, val))
                 case "humidifier":
-                    room.humidifier_device.switch_power(val)
+                    commands.append(functools.partial(
+                        room.humidifier_device.switch_power, val))
+        room.dispatcher.run(commands)
     if ("executor_setting" in settings and len(settings["executor_setting"])):
+        commands = []
         for exe, val in settings["executor_setting"].items():
             val = int(val)
             match exe:
                 case "ac":
-                    room.ac_device.set_temperature(val)
+                    commands.append(functools.partial(
+                        room.ac_device.set_temperature, val))
                 case "vent":
-                    room.vent_device.set_speed(val)
+                    commands.append(functools.partial(
+                        room.vent_device.set_speed, val))
                 case "heater":
-                    room.heater_device.set_heating_power(val)
+                    commands.append(functools.partial(
+                        room.heater_device.set_heating_power, val))
                 case "humidifier":
-                    room.humidifier_device.set_volume(val)
+                    commands.append(functools.partial(
+                        room.humidifier_device.set_volume, val))
+        room.dispatcher.run(commands)
     if ("executor_address" in settings and len(settings["executor_address"])):
         for exe, val in settings["executor_address"].items():
             match exe:
@@ -108,20 +257,22 @@ def api_device_settings():
                 case "humidifier":
                     room.humidifier_device.redefinition_address(val)
     if ("executor_autocontrol" in settings and len(settings["executor_autocontrol"])):
+        autocontrol = {}
         for exe, val in settings["executor_autocontrol"].items():
             match exe:
                 case "ac":
                     print(exe, val)
-                    room.autocontrol_ac=val
+                    autocontrol["autocontrol_ac"] = val
                 case "vent":
                     print(exe, val)
-                    room.autocontrol_vent=val
+                    autocontrol["autocontrol_vent"] = val
                 case "heater":
                     print(exe, val)
-                    room.autocontrol_heater=val
+                    autocontrol["autocontrol_heater"] = val
                 case "humidifier":
                     print(exe, val)
-                    room.autocontrol_humidifier=val
+                    autocontrol["autocontrol_humidifier"] = val
+        room.update_state(autocontrol)
         print(room.autocontrol_ac,room.autocontrol_heater,room.autocontrol_humidifier,room.autocontrol_vent)
     if ("executor_token" in settings and len(settings["executor_token"])):
         for exe, val in settings["executor_token"].items():
@@ -134,40 +285,23 @@ def api_device_settings():
                     room.heater_device.redefinition_token(val)
                 case "humidifier":
                     room.humidifier_device.redefinition_token(val)
-        room.make_token_list()
     if ("sensor_new_token" in settings and len(settings["sensor_new_token"])):
         for sensor, val in settings["sensor_new_token"].items():
-            match sensor:
-                case "temperature":
-                    room.temperature_sensor.redefinition_token(val)
-                case "temperature_outer":
-                    room.temperature_sensor_outer.redefinition_token(val)
-                case "humidity":
-                    room.humidity_sensor.redefinition_token(val)
-                case "humidity_outer":
-                    room.humidity_sensor_outer.redefinition_token(val)
-                case "co2":
-                    room.co2_sensor.redefinition_token(val)
-        room.make_token_list()
+            if sensor in room.sensors:
+                room.sensors[sensor].redefinition_token(val)
+        registry.refresh_tokens()
     if ("sensor_remove" in settings and len(settings["sensor_remove"])):
         for sensor, val in settings["sensor_remove"].items():
-            match sensor:
-                case "temperature":
-                    room.temperature_sensor.remove_token()
-                case "temperature_outer":
-                    room.temperature_sensor_outer.remove_token()
-                case "humidity":
-                    room.humidity_sensor.remove_token()
-                case "humidity_outer":
-                    room.humidity_sensor_outer.remove_token()
-                case "co2":
-                    room.co2_sensor.remove_token()
-        room.make_token_list()
+            if sensor in room.sensors:
+                room.sensors[sensor].remove_token()
+        registry.refresh_tokens()
+    room.touch()
     return Response(status=200)
 
 
 @app.route("/api/common/settings", methods=["POST"])
 def api_get_settings():
+    room = get_room()
     settings = request.json
     settings["co2"]["acceptable"] = float(settings["co2"]["acceptable"])
     settings["co2"]["harmful"] = float(settings["co2"]["harmful"])
@@ -179,30 +313,33 @@ def api_get_settings():
     settings["period"]["forecast"] = int(settings["period"]["forecast"])
     settings["period"]["report"] = int(settings["period"]["report"])
 
-    if room.co2_sensor.validate(settings["co2"]["acceptable"]):
-        room.co2_requirement_acceptable = settings["co2"]["acceptable"]
-    if room.co2_sensor.validate(settings["co2"]["harmful"]):
-        room.co2_requirement_harmful = settings["co2"]["harmful"]
-    if room.co2_sensor.validate(settings["co2"]["danger"]):
-        room.co2_requirement_danger = settings["co2"]["danger"]
-    if room.temperature_sensor.validate(settings["temperature"]["inf"]):
-        room.temperature_requirement_inf = settings["temperature"]["inf"]
-    if room.temperature_sensor.validate(settings["temperature"]["sup"]):
-        room.temperature_requirement_sup = settings["temperature"]["sup"]
-    if room.humidity_sensor.validate(settings["humidity"]["inf"]):
-        room.humidity_requirement_inf = settings["humidity"]["inf"]
-    if room.humidity_sensor.validate(settings["humidity"]["sup"]):
-        room.humidity_requirement_sup = settings["humidity"]["sup"]
+    state = {}
+    if SENSOR_KINDS["co2"].validate(settings["co2"]["acceptable"]):
+        state["co2_requirement_acceptable"] = settings["co2"]["acceptable"]
+    if SENSOR_KINDS["co2"].validate(settings["co2"]["harmful"]):
+        state["co2_requirement_harmful"] = settings["co2"]["harmful"]
+    if SENSOR_KINDS["co2"].validate(settings["co2"]["danger"]):
+        state["co2_requirement_danger"] = settings["co2"]["danger"]
+    if SENSOR_KINDS["temperature"].validate(settings["temperature"]["inf"]):
+        state["temperature_requirement_inf"] = settings["temperature"]["inf"]
+    if SENSOR_KINDS["temperature"].validate(settings["temperature"]["sup"]):
+        state["temperature_requirement_sup"] = settings["temperature"]["sup"]
+    if SENSOR_KINDS["humidity"].validate(settings["humidity"]["inf"]):
+        state["humidity_requirement_inf"] = settings["humidity"]["inf"]
+    if SENSOR_KINDS["humidity"].validate(settings["humidity"]["sup"]):
+        state["humidity_requirement_sup"] = settings["humidity"]["sup"]
     if settings["period"]["forecast"] > 10 and settings["period"]["forecast"] < 3600:
-        room.forecast_period = datetime.timedelta(seconds=settings["period"]["report"])
+        state["forecast_period"] = datetime.timedelta(seconds=settings["period"]["report"])
     if settings["period"]["report"] > 10 and settings["period"]["report"] < 3600:
-        room.report_period = datetime.timedelta(seconds=settings["period"]["forecast"])
+        state["report_period"] = datetime.timedelta(seconds=settings["period"]["forecast"])
+    room.update_state(state)
 
     return Response(status=201)
 
 
 @app.route("/api/get/settings")
 def api_send_settings():
+    room = get_room()
     answer = {
         "co2": {"acceptable": room.co2_requirement_acceptable,
                 "harmful": room.co2_requirement_harmful,
@@ -219,11 +356,12 @@ def api_send_settings():
 
 @app.route("/api/get/device_status")
 def api_get_devices_statistic():
+    room = get_room()
     answer = {"executor_on": {},
               "executor_setting": {},
               "executor_address": {},
               "executor_autocontrol": {}, }
-    report = room.make_report()
+    report = room.get_report()
     answer["executor_on"] = report["devices_status"]
 
     answer["executor_setting"]["ac"] = room.ac_device.settings
@@ -246,22 +384,104 @@ def api_get_devices_statistic():
 
 @app.route("/api/get/report", methods=["GET"])
 def api_get_report():
+    room = get_room()
+    modified = room.get_modified()
+    if modified is not None:
+        # Отчёт меняется с каждым измерением и изменением настроек, а окно
+        # отчёта сдвигается и без них: кэш считает отчёт устаревшим через
+        # REPORT_CACHE_TTL, поэтому валидаторы меняются не реже
+        modified = max(modified, time.time() // REPORT_CACHE_TTL * REPORT_CACHE_TTL)
+        etag = f"report-{room.data_version}-{modified:.6f}-{request.args.get('period', '')}"
+        if not_modified(etag, modified):
+            return Response(status=304)
+        since = request.args.get("since", type=float)
+        if since is not None and modified <= since:
+            return Response(status=304)
     if request.args.get("period"):
         period = datetime.timedelta(seconds=int(request.args.get("period")))
-        report = room.make_report(period)
+        report = room.get_report(period)
     else:
-        report = room.make_report()
-    return report
+        report = room.get_report()
+    if modified is None:
+        return report
+    return conditional(report, etag, modified)
 
 
 @app.route("/api/get/data", methods=["GET"])
 def api_get_data():
+    room = get_room()
+    fields = None
+    points = None
+    if request.args.get("fields"):
+        fields = request.args.get("fields").split(",")
+    if request.args.get("points"):
+        points = max(int(request.args.get("points")), 3)
+    method = request.args.get("method", "lttb")
     if request.args.get("period"):
         period = datetime.timedelta(seconds=int(request.args.get("period")))
-        history = room.get_history(period)
     else:
-        history = room.get_history(datetime.timedelta(hours=6))
-    return history
+        period = datetime.timedelta(hours=6)
+    since, period = get_since(period)
+    binary = request.args.get("format") == "binary"
+    # Журнал и устройства не отслеживаются: без fields проверка только для binary
+    modified = None
+    if fields is not None or binary:
+        modified = room.get_modified(fields)
+    if modified is not None:
+        etag = f"data-{modified:.6f}"
+        if not_modified(etag, modified):
+            return Response(status=304)
+    if binary:
+        data = room.get_history_columns(period, fields, points, method, since)
+        response = Response(data, mimetype="application/octet-stream")
+    else:
+        response = room.get_history(period, fields, points, method, since)
+    if modified is None:
+        return response
+    return conditional(response, etag, modified)
+
+@app.route("/api/stream", methods=["GET"])
+def api_stream():
+    """Поток событий помещения (Server-Sent Events): report и sample.
+    Отчёт считается один раз на всех подписчиков"""
+    room = get_room()
+    subscription = registry.hub.subscribe(room.name)
+
+    def events():
+        try:
+            if room.report:
+                yield f"event: report\ndata: {json_dumps(room.report).decode()}\n\n"
+            while True:
+                try:
+                    yield subscription.get(timeout=STREAM_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+        finally:
+            registry.hub.unsubscribe(room.name, subscription)
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route("/api/get/udp_stats", methods=["GET"])
+def api_get_udp_stats():
+    if udp_listener is None:
+        abort(404)
+    return udp_listener.get_stats()
+
+
+@app.route("/api/get/export", methods=["GET"])
+def api_get_export():
+    room = get_room()
+    period = datetime.timedelta(seconds=int(request.args.get("period", 6 * 3600)))
+    fields = None
+    if request.args.get("fields"):
+        fields = request.args.get("fields").split(",")
+    fmt = request.args.get("format", "ndjson")
+    batch_size = int(request.args.get("batch", EXPORT_BATCH_SIZE))
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    rows = room.export_history(period, fields, fmt, batch_size)
+    return Response(stream_with_context(rows), mimetype=mimetype)
 
 # UI
 
@@ -273,7 +493,8 @@ def main_page():
 
 @app.route("/report")
 def report_page():
-    report = room.make_report()
+    room = get_room()
+    report = room.get_report()
     return render_template("report.html", report=report)
 
 
@@ -1,18 +1,253 @@
+"""Нагрузочное тестирование: имитация N помещений по M датчиков.
+
+Показания отправляются с заданной частотой из нескольких соединений,
+по каждому адресу API выводятся пропускная способность и задержки
+p50/p95/p99. С --serve приложение запускается в этом же процессе
+(с --mock - на mongomock) вместе с заглушками ИУ.
+
+    python masquarade.py --serve --mock --rooms 4 --sensors 5 --rate 500 --duration 30
+    python masquarade.py --legacy    # прежний режим: 5 показаний раз в 45 с
+"""
+import argparse
 import datetime
+import http.server
+import json
+import math
+import queue
+import random
+import threading
+import time
+import numpy as np
 import requests
 import env
-import random
-
-"""Скрипт имитирует отправку данных с блока датчика в целях тестирования"""
 
-url = "http://localhost:5000/api/device/send"
+KINDS = ["temperature", "humidity", "temperature_outer", "humidity_outer", "co2"]
+# Среднее и разброс показаний по типу датчика
+VALUES = {"temperature": (23, 1), "humidity": (50, 4), "temperature_outer": (17, 1),
+          "humidity_outer": (50, 3), "co2": (700, 100)}
+# Границы корзин гистограммы задержек [ms]
+HISTOGRAM = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000]
 timeout = 1.5
 
-m_t = 23
-m_phi = 50
-m_co2 = 700
-m_o_t = 17
-m_o_phi = 50
+
+class ValueModel:
+    """Модель показаний датчика: noise - шум около среднего,
+    sine - суточное колебание с шумом, walk - случайное блуждание"""
+
+    def __init__(self, kind: str, model: str = "noise", period: float = 600) -> None:
+        self.mean, self.deviation = VALUES[kind]
+        self.model = model
+        self.period = period  # [s]
+        self.phase = random.uniform(0, 2 * math.pi)
+        self.value = self.mean
+
+    def next(self, moment: float) -> float:
+        noise = random.uniform(-self.deviation, self.deviation)
+        if self.model == "sine":
+            return self.mean + 2 * self.deviation * \
+                math.sin(2 * math.pi * moment / self.period + self.phase) + noise / 4
+        if self.model == "walk":
+            self.value += noise / 4
+            # Блуждание удерживается около среднего
+            self.value += (self.mean - self.value) * 0.01
+            return self.value
+        return self.mean + noise
+
+
+class LatencyStats:
+    """Задержки и коды ответов по адресам API"""
+
+    def __init__(self) -> None:
+        self.latency: dict[str, list] = {}
+        self.status: dict[str, dict] = {}
+        self.lag = []
+        self._lock = threading.Lock()
+
+    def record(self, endpoint: str, latency: float, status, lag: float = None):
+        with self._lock:
+            self.latency.setdefault(endpoint, []).append(latency)
+            codes = self.status.setdefault(endpoint, {})
+            codes[status] = codes.get(status, 0) + 1
+            if lag is not None:
+                self.lag.append(lag)
+
+    def summary(self, elapsed: float) -> dict:
+        result = {}
+        with self._lock:
+            for endpoint, values in self.latency.items():
+                values = np.array(values)
+                histogram, _ = np.histogram(values, [0] + HISTOGRAM + [np.inf])
+                result[endpoint] = {
+                    "requests": len(values),
+                    "rps": len(values) / elapsed,
+                    "status": {str(k): v for k, v in self.status[endpoint].items()},
+                    "p50": float(np.percentile(values, 50)),
+                    "p95": float(np.percentile(values, 95)),
+                    "p99": float(np.percentile(values, 99)),
+                    "max": float(values.max()),
+                    "histogram": dict(zip([f"<{x}" for x in HISTOGRAM] + [f">={HISTOGRAM[-1]}"],
+                                          histogram.tolist())),
+                }
+            if self.lag:
+                # Отставание отправки от расписания: сервер не успевает за частотой
+                result["schedule_lag"] = {"p50": float(np.percentile(self.lag, 50)),
+                                          "p99": float(np.percentile(self.lag, 99))}
+        return result
+
+
+class StubExecutor(http.server.BaseHTTPRequestHandler):
+    """Заглушка ИУ: принимает любую команду"""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = b'{"status": "ok"}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_executors() -> str:
+    """Запустить заглушки ИУ и вернуть их адрес"""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubExecutor)
+    threading.Thread(target=server.serve_forever, name="stub-executors",
+                     daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def make_rooms(rooms: int, executors: str) -> list[dict]:
+    """Конфигурация помещений для env.ROOMS"""
+    return [{
+        "name": f"room{i}",
+        "sensors": {kind: {"name": f"room{i}_{kind}", "token": f"room{i}_{kind}_token"}
+                    for kind in KINDS},
+        "executors": {kind: {"name": f"room{i}_{kind}", "address": f"{executors}/room{i}/{kind}",
+                             "token": f"room{i}_{kind}_executor"}
+                      for kind in ["ac", "heater", "vent", "humidifier"]},
+        "settings": {"heater": 400, "ac": 16, "vent": 100, "humidifier": 80},
+        "autocontrol": {"vent": True, "ac": True, "heater": True, "humidifier": True},
+    } for i in range(rooms)]
+
+
+def serve(rooms: list[dict], mock: bool) -> str:
+    """Запустить приложение в этом процессе и вернуть его адрес"""
+    env.ROOMS = rooms
+    if mock:
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = lambda **kwargs: mongomock.MongoClient()
+        # mongomock выполняет не все операции bulk_write, нужные агрегатам
+        env.DB_ROLLUPS = False
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    import main
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args):
+            pass
+
+    server = make_server("127.0.0.1", 0, main.app, threaded=True,
+                         request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, name="app",
+                     daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def get_targets(rooms: list[dict], sensors: int) -> list[dict]:
+    """Блоки датчиков: помещение и первые sensors его датчиков (токен, тип)"""
+    return [{"room": room["name"],
+             "sensors": [(room["sensors"][kind]["token"], kind) for kind in KINDS[:sensors]]}
+            for room in rooms]
+
+
+def run_load(url: str, targets: list[dict], args) -> dict:
+    """Отправлять показания с частотой args.rate в args.connections соединений"""
+    stats = LatencyStats()
+    models = {token: ValueModel(kind, args.model)
+              for target in targets for token, kind in target["sensors"]}
+    jobs = queue.Queue(maxsize=args.connections * 100)
+    deadline = time.perf_counter() + args.duration
+    started = time.perf_counter()
+
+    def produce():
+        # Блок отправляет пакет всех своих датчиков либо по одному показанию
+        if args.batch:
+            units = [(x["room"], x["sensors"]) for x in targets]
+        else:
+            units = [(x["room"], [sensor]) for x in targets for sensor in x["sensors"]]
+        interval = len(units[0][1]) / args.rate
+        moment = time.perf_counter()
+        index = 0
+        while moment < deadline:
+            jobs.put((moment, units[index % len(units)]))
+            index += 1
+            moment += interval
+            delay = moment - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        for _ in range(args.connections):
+            jobs.put(None)
+
+    def send():
+        session = requests.Session()
+        while (job := jobs.get()) is not None:
+            scheduled, (room, sensors) = job
+            begin = time.perf_counter()
+            readings = [{"Auth": token, "value": models[token].next(time.time())}
+                        for token, _ in sensors]
+            if args.batch:
+                endpoint = "/api/device/send_batch"
+                body = {"readings": readings}
+            else:
+                endpoint = "/api/device/send"
+                body = readings[0]
+            try:
+                status = session.post(url + endpoint, json=body, timeout=timeout).status_code
+            except requests.RequestException:
+                status = "timeout"
+            stats.record(endpoint, (time.perf_counter() - begin) * 1000, status,
+                         (begin - scheduled) * 1000)
+
+    def read():
+        session = requests.Session()
+        rooms = [x["room"] for x in targets]
+        while time.perf_counter() < deadline:
+            room = random.choice(rooms)
+            for endpoint, query in [("/api/get/report", ""),
+                                    ("/api/get/data", "&period=3600&fields=temperature&points=500&format=binary")]:
+                begin = time.perf_counter()
+                try:
+                    status = session.get(f"{url}{endpoint}?room={room}{query}",
+                                         timeout=timeout).status_code
+                except requests.RequestException:
+                    status = "timeout"
+                stats.record(endpoint, (time.perf_counter() - begin) * 1000, status)
+            time.sleep(args.read_interval)
+
+    threads = [threading.Thread(target=produce, daemon=True)]
+    threads += [threading.Thread(target=send, daemon=True) for _ in range(args.connections)]
+    threads += [threading.Thread(target=read, daemon=True) for _ in range(args.readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats.summary(time.perf_counter() - started)
+
+
+def print_summary(summary: dict):
+    print(f"{'endpoint':<26}{'requests':>9}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}  status")
+    for endpoint, x in summary.items():
+        if endpoint == "schedule_lag":
+            continue
+        print(f"{endpoint:<26}{x['requests']:>9}{x['rps']:>9.1f}{x['p50']:>9.2f}"
+              f"{x['p95']:>9.2f}{x['p99']:>9.2f}{x['max']:>9.2f}  {x['status']}")
+        print(" " * 26 + "  ".join(f"{k}:{v}" for k, v in x["histogram"].items() if v))
+    if "schedule_lag" in summary:
+        print(f"schedule lag [ms]: p50 {summary['schedule_lag']['p50']:.2f}, "
+              f"p99 {summary['schedule_lag']['p99']:.2f}")
 
 
 def make_request(url, m, devi, token):
@@ -25,17 +260,61 @@ def make_request(url, m, devi, token):
     except:
         res = {"error": "timeout"}
 
-make_request(url, m_t, 1, env.SENSOR_TEMPERATURE_TOKEN)
-make_request(url, m_phi, 4, env.SENSOR_HUMIDITY_TOKEN)
-make_request(url, m_o_t, 1, env.SENSOR_TEMPERATURE_OUTER_TOKEN)
-make_request(url, m_o_phi, 3, env.SENSOR_HUMIDITY_OUTER_TOKEN)
-make_request(url, m_co2, 100, env.SENSOR_CO2_TOKEN)
-
-while True:
-    if int(datetime.datetime.now().timestamp()) % 45 == 0:
-        make_request(url, m_t, 1, env.SENSOR_TEMPERATURE_TOKEN)
-        make_request(url, m_phi, 4, env.SENSOR_HUMIDITY_TOKEN)
-        make_request(url, m_o_t, 1, env.SENSOR_TEMPERATURE_OUTER_TOKEN)
-        make_request(url, m_o_phi, 3, env.SENSOR_HUMIDITY_OUTER_TOKEN)
-        make_request(url, m_co2, 100, env.SENSOR_CO2_TOKEN)
-        print()
+
+def legacy(url: str):
+    """Прежний режим: показания одного блока датчиков раз в 45 с"""
+    url = url + "/api/device/send"
+    tokens = [(23, 1, env.SENSOR_TEMPERATURE_TOKEN), (50, 4, env.SENSOR_HUMIDITY_TOKEN),
+              (17, 1, env.SENSOR_TEMPERATURE_OUTER_TOKEN),
+              (50, 3, env.SENSOR_HUMIDITY_OUTER_TOKEN), (700, 100, env.SENSOR_CO2_TOKEN)]
+    for m, devi, token in tokens:
+        make_request(url, m, devi, token)
+    while True:
+        if int(datetime.datetime.now().timestamp()) % 45 == 0:
+            for m, devi, token in tokens:
+                make_request(url, m, devi, token)
+            print()
+        time.sleep(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--rooms", type=int, default=1)
+    parser.add_argument("--sensors", type=int, default=5, choices=range(1, 6),
+                        help="датчиков в помещении, отправляющих показания")
+    parser.add_argument("--rate", type=float, default=100, help="показаний в секунду")
+    parser.add_argument("--duration", type=float, default=30, help="[s]")
+    parser.add_argument("--connections", type=int, default=16)
+    parser.add_argument("--model", choices=["noise", "sine", "walk"], default="noise")
+    parser.add_argument("--batch", action="store_true",
+                        help="блок отправляет показания всех датчиков одним пакетом")
+    parser.add_argument("--readers", type=int, default=0,
+                        help="клиентов, читающих отчёт и график")
+    parser.add_argument("--read-interval", type=float, default=1.0, help="[s]")
+    parser.add_argument("--serve", action="store_true",
+                        help="запустить приложение и заглушки ИУ в этом процессе")
+    parser.add_argument("--mock", action="store_true", help="mongomock вместо MongoDB")
+    parser.add_argument("--json", help="сохранить результат в файл")
+    parser.add_argument("--legacy", action="store_true")
+    args = parser.parse_args()
+
+    if args.legacy:
+        legacy(args.url)
+    if args.serve:
+        rooms = make_rooms(args.rooms, start_stub_executors())
+        url = serve(rooms, args.mock)
+    else:
+        url = args.url
+        # Внешний сервер: помещения из env.ROOMS или одно помещение по умолчанию
+        rooms = getattr(env, "ROOMS", None) or [{"name": "main", "sensors": {
+            "temperature": {"token": env.SENSOR_TEMPERATURE_TOKEN},
+            "humidity": {"token": env.SENSOR_HUMIDITY_TOKEN},
+            "temperature_outer": {"token": env.SENSOR_TEMPERATURE_OUTER_TOKEN},
+            "humidity_outer": {"token": env.SENSOR_HUMIDITY_OUTER_TOKEN},
+            "co2": {"token": env.SENSOR_CO2_TOKEN}}}]
+    summary = run_load(url, get_targets(rooms, args.sensors), args)
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"args": vars(args), "results": summary}, file, indent=2)
@@ -19,6 +19,7 @@ class TranslateAssassment {
             let new_label = this.dst[index];
             let accent_label = this.accents[index];
             element.innerText = new_label;
+            element.classList.remove(...this.accents);
             element.classList.add(accent_label);
         }
     }
@@ -52,6 +53,33 @@ function timedelta(date, shift) {
     return dst
 }
 
+// Разбор колоночного бинарного формата /api/get/data?format=binary
+function parse_columns(buffer) {
+    let view = new DataView(buffer);
+    let decoder = new TextDecoder();
+    let columns = {};
+    let count = view.getUint32(4, true);
+    let offset = 8;
+    for (let i = 0; i < count; i++) {
+        let name_length = view.getUint32(offset, true);
+        let name = decoder.decode(new Uint8Array(buffer, offset + 4, name_length));
+        offset += 4 + name_length;
+        offset += (8 - offset % 8) % 8;
+        let points = view.getUint32(offset, true);
+        offset += 8;
+        let x = new Float64Array(buffer, offset, points);
+        offset += points * 8;
+        let y = new Float32Array(buffer, offset, points);
+        offset += points * 4;
+        offset += (8 - offset % 8) % 8;
+        columns[name] = { x: x, y: y };
+    }
+    return columns;
+}
+
+// Построенный ряд: при повторном построении запрашиваются только новые точки
+let plot_state = null;
+
 function make_plot() {
     let period = Number(document.getElementById("plot_period_selector").value) * 3600;
     let field = document.getElementById("plot_field_selector").value;
@@ -83,38 +111,80 @@ function make_plot() {
 
     let layout = {
         title: title,
+        xaxis: {
+            type: "date",
+        },
         yaxis: {
             title: units,
         }
     }
 
     let host = window.location.host;
-    let url = "http://" + host + "/api/get/data" + "?period=" + period;
+    let points = Math.max(document.getElementById("plot_area").clientWidth, 500);
+    let url = "http://" + host + "/api/get/data" + "?period=" + period +
+        "&fields=" + field + "&points=" + points + "&format=binary";
+    let delta = plot_state !== null && plot_state.field === field &&
+        plot_state.period === period && plot_state.last !== null;
+    if (delta) {
+        url += "&since=" + plot_state.last / 1000;
+    }
     let request = new Request(url);
-    let raw_data = new Set;
-    let data;
-    let x_array = [];
-    let y_array = [];
     fetch(request)
         .then((response) => {
             if (response.status === 200) {
-                return response.json();
+                return response.arrayBuffer();
             } else {
                 throw new Error("Host doesn't answer");
             }
         })
-        .then((response) => {
-            raw_data = response[field];
-            for (let i = 0; i < raw_data.length; i++) {
-                x_array[i] = new Date(raw_data[i]["date"]).toISOString();
-                y_array[i] = Number(raw_data[i][field]);
+        .then((buffer) => {
+            let data = parse_columns(buffer)[field];
+            if (delta) {
+                if (data.x.length > 0) {
+                    Plotly.extendTraces("plot_area", { x: [data.x], y: [data.y] }, [0]);
+                }
+            } else {
+                Plotly.newPlot("plot_area", [data], layout);
+                plot_state = { field: field, period: period, last: null };
+            }
+            if (data.x.length > 0) {
+                plot_state.last = data.x[data.x.length - 1];
             }
-            data = { x: x_array, y: y_array };
-            Plotly.newPlot("plot_area", [data], layout);
         });
 }
 
+// Живое обновление сводки и графика по событиям /api/stream
+function subscribe() {
+    let host = window.location.host;
+    let source = new EventSource("http://" + host + "/api/stream" + window.location.search);
+    source.addEventListener("report", (event) => {
+        let report = JSON.parse(event.data);
+        for (let field in report.value) {
+            let value = document.getElementById("value_" + field);
+            let assessment = document.getElementById("assessment_" + field);
+            // Для типов измерений из env.SENSOR_KINDS на странице нет полей
+            if (value !== null) {
+                value.innerText = report.value[field];
+            }
+            if (assessment !== null && field in report.assessment) {
+                assessment.innerText = report.assessment[field];
+            }
+        }
+        translate_assessments();
+    });
+    source.addEventListener("sample", (event) => {
+        let sample = JSON.parse(event.data);
+        let plot = document.getElementById("plot_area");
+        if (sample.field !== document.getElementById("plot_field_selector").value || !plot.data) {
+            return;
+        }
+        Plotly.extendTraces("plot_area", { x: [sample.dates], y: [sample.values] }, [0]);
+        plot_state.last = Math.max(plot_state.last, ...sample.dates);
+    });
+}
+
 function init() {
     translate_assessments();
     make_plot();
+    subscribe();
 }
\ No newline at end of file
@@ -0,0 +1,143 @@
+# Приём измерений по UDP в компактном двоичном формате.
+# Датаграмма: длина токена (1 байт), токен (UTF-8), затем записи
+# по 16 байт: номер (uint32), время (float64, секунды эпохи; 0 - время приёма),
+# значение (float32). Порядок байт - little-endian
+import socket
+import struct
+import threading
+import env
+from classes import RoomRegistry
+
+UDP_HOST = getattr(env, "UDP_HOST", "0.0.0.0")
+UDP_PORT = getattr(env, "UDP_PORT", None)
+UDP_RECORD = struct.Struct("<Idf")
+UDP_MAX_DATAGRAM = 65507
+# Сколько последних пропущенных номеров помнить, чтобы принять их с опозданием
+UDP_REORDER_WINDOW = getattr(env, "UDP_REORDER_WINDOW", 1024)
+# Повтор принятого номера отстаёт от последнего не больше чем на столько записей;
+# номер дальше позади означает перезапуск нумерации
+UDP_DUPLICATE_WINDOW = getattr(env, "UDP_DUPLICATE_WINDOW", 16)
+
+
+def pack_datagram(token: str, records: list[tuple]) -> bytes:
+    """Упаковать измерения (номер, время, значение) одного датчика"""
+    token = token.encode()
+    return bytes([len(token)]) + token + b"".join(
+        UDP_RECORD.pack(seq, date, value) for seq, date, value in records)
+
+
+def unpack_datagram(data: bytes) -> tuple[str, list[tuple]]:
+    """Разобрать датаграмму на токен и записи (номер, время, значение)"""
+    if len(data) == 0:
+        raise ValueError("Empty datagram")
+    end = 1 + data[0]
+    if len(data) < end or (len(data) - end) % UDP_RECORD.size != 0:
+        raise ValueError("Malformed datagram")
+    return data[1:end].decode(), list(UDP_RECORD.iter_unpack(data[end:]))
+
+
+class UDPListener:
+    """Приём измерений по UDP с учётом потерь по номерам записей"""
+
+    def __init__(self, registry: RoomRegistry, host: str = UDP_HOST, port: int = UDP_PORT) -> None:
+        self.registry = registry
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.address = self.socket.getsockname()
+        # Статистика по именам датчиков (токены не раскрываются):
+        # последний номер, принято, потеряно, повторы, перезапуски нумерации
+        self.stats: dict[str, dict] = {}
+        self._missing: dict[str, set] = {}
+        # Первый номер текущей нумерации датчика и время блока у последнего номера
+        self._first: dict[str, int] = {}
+        self._last_date: dict[str, float] = {}
+        self._stats_lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._run, name="udp-listener", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        print(f"UDP listener started on {self.address[0]}:{self.address[1]}")
+
+    def stop(self):
+        self.socket.close()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            try:
+                data, _ = self.socket.recvfrom(UDP_MAX_DATAGRAM)
+            except OSError:
+                break
+            try:
+                self.processing_datagram(data)
+            except Exception as error:
+                print(f"UDP datagram rejected: {error}")
+
+    def processing_datagram(self, data: bytes) -> list[int]:
+        """Проверить номера записей и передать новые измерения в реестр"""
+        token, records = unpack_datagram(data)
+        route = self.registry.route(token)
+        if route is None:
+            return [401] * len(records)
+        records = self.track(route[1].name, records)
+        readings = [{"value": value, "date": date or None}
+                    for _, date, value in records]
+        if len(readings) == 0:
+            return []
+        return self.registry.processing_batch(readings, token)
+
+    def track(self, sensor: str, records: list[tuple]) -> list[tuple]:
+        """Учесть номера записей датчика: пропуски считаются потерями,
+        уже принятые номера отбрасываются как повторы.
+        Номер раньше начала нумерации, далеко позади последнего или с временем
+        блока новее последнего означает перезапуск нумерации"""
+        fresh = []
+        with self._stats_lock:
+            stats = self.stats.setdefault(
+                sensor, {"last": None, "received": 0, "lost": 0, "duplicates": 0,
+                         "restarts": 0})
+            missing = self._missing.setdefault(sensor, set())
+            for record in sorted(records):
+                seq, date = record[0], record[1]
+                if stats["last"] is not None and seq <= stats["last"] and \
+                        seq not in missing and self.restarted(sensor, seq, date):
+                    # Блок перезагружен или счётчик uint32 переполнился
+                    stats["restarts"] += 1
+                    stats["last"] = None
+                    missing.clear()
+                if stats["last"] is None:
+                    self._first[sensor] = seq
+                if stats["last"] is not None and seq <= stats["last"]:
+                    if seq in missing:
+                        # Запоздавшая запись, ранее учтённая как потерянная
+                        missing.discard(seq)
+                        stats["lost"] -= 1
+                        stats["received"] += 1
+                        fresh.append(record)
+                    else:
+                        stats["duplicates"] += 1
+                    continue
+                if stats["last"] is not None and seq > stats["last"] + 1:
+                    stats["lost"] += seq - stats["last"] - 1
+                    missing.update(range(max(stats["last"] + 1, seq - UDP_REORDER_WINDOW), seq))
+                stats["last"] = seq
+                self._last_date[sensor] = date
+                stats["received"] += 1
+                fresh.append(record)
+            if len(missing) > UDP_REORDER_WINDOW:
+                missing.difference_update(
+                    [x for x in missing if x <= stats["last"] - UDP_REORDER_WINDOW])
+        return fresh
+
+    def restarted(self, sensor: str, seq: int, date: float) -> bool:
+        """Принятый ранее номер пришёл не как повтор, а после перезапуска нумерации"""
+        last_date = self._last_date[sensor]
+        if seq < self._first[sensor] or self.stats[sensor]["last"] - seq > UDP_DUPLICATE_WINDOW:
+            return True
+        # Повтор несёт прежнее время блока (0 - время блока не передаётся)
+        return bool(date and last_date and date > last_date)
+
+    def get_stats(self) -> dict[str, dict]:
+        with self._stats_lock:
+            return {sensor: dict(x) for sensor, x in self.stats.items()}